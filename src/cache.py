@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+
+class LRUCache:
+    """A thread-safe read-through cache with optional TTL and bounded-size LRU eviction.
+
+    Entries live until the end of the current cycle (see `new_cycle`) unless a `ttl` is given,
+    in which case they are kept across cycles until they expire.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _lookup(self, key: Hashable) -> Optional[tuple]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, _ = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the cached value for key or call loader() and cache its result.
+        Concurrent callers missing the same key wait for a single call to loader()
+        """
+
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[1]
+                self.misses += 1
+
+            try:
+                value = loader()
+                self.set(key, value)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+        return value
+
+    def invalidate(self, key: Hashable = None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def forget_cycle(self, key: Hashable):
+        """Drop an entry meant to live for the current cycle only, e.g. before reading it again between cycles.
+        Entries kept for a ttl are left alone
+        """
+
+        if not self.ttl:
+            self.invalidate(key)
+
+    def new_cycle(self):
+        """Drop entries that should not outlive a cycle. The hit/miss counters are reset by `take_stats`"""
+
+        with self._lock:
+            if not self.ttl:
+                self._data.clear()
+
+    def dump(self) -> List[Tuple[Hashable, float, Any]]:
+        """The (key, seconds to live, value) of the entries kept across cycles, e.g. to persist them"""
+
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, expires - now, value)
+                for key, (expires, value) in self._data.items()
+                if expires is not None and expires > now
+            ]
+
+    def load(self, entries: List[Tuple[Hashable, float, Any]]):
+        """Add entries from `dump`, expiring when they would have. Nothing is loaded into a cache without a ttl"""
+
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key, ttl, value in entries:
+                if ttl > 0 and key not in self._data:
+                    self._data[key] = (now + min(ttl, self.ttl), value)
+            while self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+    def take_stats(self) -> dict:
+        """The stats since they were last taken, including lookups between cycles, and reset the hit/miss counters"""
+
+        with self._lock:
+            stats = self.stats()
+            self.hits = self.misses = 0
+        return stats
+
+
+def from_env(prefix: str, max_size: int = 1024, ttl: float = 0) -> LRUCache:
+    """Create a cache configured from the environment variables {prefix}_CACHE_SIZE and {prefix}_CACHE_TTL"""
+
+    return LRUCache(
+        max_size=int(os.environ.get(f"{prefix}_CACHE_SIZE", max_size)),
+        ttl=float(os.environ.get(f"{prefix}_CACHE_TTL", ttl)),
+    )
@@ -0,0 +1,159 @@
+import datetime
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Iterable, List, Set
+
+import docker
+import docker.errors
+from docker.models.secrets import Secret as DockerSecret
+
+import metrics
+import services
+
+
+def cleanup_enabled() -> bool:
+    """Remove superseded Docker secrets created by vault-swarm once per INTERVAL (SECRET_CLEANUP)"""
+
+    return os.environ.get("SECRET_CLEANUP", "false").lower() in ("1", "true", "yes")
+
+
+# With SHARDING, only the replica that owns this key runs the cleanup
+OWNER_KEY = "secret-cleanup"
+
+_last_run = None
+
+
+def cleanup_due(interval: float) -> bool:
+    """Whether to run the cleanup now. It lists every service and secret of the swarm, so it runs at most once
+    per `interval` seconds rather than every cycle. Counts the cleanup as run when it is due
+    """
+
+    global _last_run
+    now = time.monotonic()
+    if _last_run is not None and now - _last_run < interval:
+        return False
+    _last_run = now
+    return True
+
+
+def dry_run_enabled() -> bool:
+    return os.environ.get("SECRET_CLEANUP_DRY_RUN", "false").lower() in ("1", "true", "yes")
+
+
+def is_managed(secret: DockerSecret) -> bool:
+    """Secrets created by vault-swarm carry the Vault path, version and key they were created from"""
+
+    labels = secret.attrs["Spec"].get("Labels") or {}
+    return all(label in labels for label in ("path", "version", "name"))
+
+
+def get_age(secret: DockerSecret, now: datetime.datetime) -> float:
+    """Seconds since a secret was created. CreatedAt has nanoseconds, which datetime can not parse"""
+
+    created_at = datetime.datetime.strptime(secret.attrs["CreatedAt"][:19], "%Y-%m-%dT%H:%M:%S")
+    return (now - created_at).total_seconds()
+
+
+def get_referenced_secret_ids(client: docker.DockerClient) -> Set[str]:
+    """IDs of the secrets used by any service in the swarm, with or without vault labels"""
+
+    with metrics.api_call("docker", "services.list"):
+        all_services = client.services.list()
+
+    return {
+        secret["SecretID"]
+        for service in all_services
+        for secret in services.get_service_secrets(service) or []
+    }
+
+
+def find_superseded(secrets: Iterable[DockerSecret], referenced: Set[str], keep: int, min_age: float,
+                    now: datetime.datetime = None) -> List[DockerSecret]:
+    """Return the managed secrets that may be removed: secrets no service references, that are older than `min_age`
+    seconds and that are not among the `keep` latest versions of their Vault path and key
+    """
+
+    now = now or datetime.datetime.utcnow()
+    by_key = defaultdict(list)
+    for secret in secrets:
+        if is_managed(secret):
+            labels = secret.attrs["Spec"]["Labels"]
+            by_key[(labels["path"], labels["name"])].append(secret)
+
+    superseded = []
+    for secrets_ in by_key.values():
+        versions = sorted({int(secret.attrs["Spec"]["Labels"]["version"]) for secret in secrets_}, reverse=True)
+        kept_versions = set(versions[:keep])
+        for secret in secrets_:
+            if int(secret.attrs["Spec"]["Labels"]["version"]) in kept_versions:
+                continue
+            if secret.id in referenced or get_age(secret, now) < min_age:
+                continue
+            superseded.append(secret)
+
+    return sorted(superseded, key=lambda secret: secret.attrs["CreatedAt"])
+
+
+def remove_secrets(secrets: List[DockerSecret]) -> List[DockerSecret]:
+    """Remove secrets, skipping those a service started to use in the meantime. Returns the secrets removed"""
+
+    removed = []
+    for secret in secrets:
+        try:
+            with services.secret_index.lock:
+                with metrics.api_call("docker", "secrets.remove"):
+                    secret.remove()
+                services.secret_index.remove(secret.id)
+        except docker.errors.NotFound:
+            services.secret_index.remove(secret.id)
+            continue
+        except docker.errors.APIError as error:
+            logging.warning(f"Could not remove secret {secret.name}: {error}")
+            continue
+
+        logging.info(f"Removed superseded secret: {secret.name}")
+        metrics.secrets_removed.inc()
+        removed.append(secret)
+
+    return removed
+
+
+def cleanup(client: docker.DockerClient = None, dry_run: bool = None) -> List[DockerSecret]:
+    """Find the superseded secrets and remove up to SECRET_CLEANUP_BATCH of them, or only log them on a dry run.
+    Returns the secrets removed, or those that would have been
+    """
+
+    client = client or services.get_docker_client()
+    dry_run = dry_run_enabled() if dry_run is None else dry_run
+    keep = int(os.environ.get("SECRET_CLEANUP_KEEP", 2))
+    min_age = float(os.environ.get("SECRET_CLEANUP_MIN_AGE", 60 * 60))
+    batch_size = int(os.environ.get("SECRET_CLEANUP_BATCH", 50))
+
+    secrets = services.secret_index.secrets(client)
+    superseded = find_superseded(secrets, get_referenced_secret_ids(client), keep, min_age)
+    batch = superseded[:batch_size]
+
+    if dry_run:
+        for secret in superseded:
+            labels = secret.attrs["Spec"]["Labels"]
+            logging.info(
+                f"Would remove secret: {secret.name} - path: {labels['path']}, key: {labels['name']}, "
+                f"version: {labels['version']}, created: {secret.attrs['CreatedAt']}"
+            )
+        logging.info(f"Found {len(superseded)} superseded secrets, dry run so none were removed")
+        return superseded
+
+    removed = remove_secrets(batch)
+    logging.info(f"Removed {len(removed)} of {len(superseded)} superseded secrets")
+    return removed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(filename)s - %(funcName)s - %(message)s",
+                        level=getattr(logging, os.environ.get("LOG_LEVEL", "INFO")))
+
+    # `python cleanup.py --dry-run` reports the secrets that would be removed
+    cleanup(dry_run=True if "--dry-run" in sys.argv[1:] else None)
@@ -0,0 +1,73 @@
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+
+class Coalescer:
+    """Holds back the env and secret changes of a service until its coalescing window has passed,
+    so that several Vault rotations in a row reach the service in a single `service.update()`.
+
+    The window starts with the first pending change of a service. Changes arriving while it is open are merged
+    into it, the newest value of an env var or version of a secret winning. With a window of 0 changes are
+    passed straight through.
+    """
+
+    def __init__(self, window: float = 0):
+        self.window = window
+        self.avoided_updates = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, service_id: str, env_vars: dict, secrets: List[dict],
+               now: float = None) -> Tuple[dict, List[dict]]:
+        """Add the changes of a service and return the env vars and secrets to apply now,
+        which are empty while the window of the service is still open
+        """
+
+        if self.window <= 0:
+            return env_vars, secrets
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            pending = self._pending.get(service_id)
+            if pending is None:
+                if not env_vars and not secrets:
+                    return {}, []
+                pending = self._pending[service_id] = {"since": now, "env_vars": {}, "secrets": {}}
+            elif self._is_new_change(pending, env_vars, secrets):
+                self.avoided_updates += 1
+
+            pending["env_vars"].update(env_vars)
+            for secret in secrets:
+                key = (secret["path"], secret["name"])
+                if key not in pending["secrets"] or pending["secrets"][key]["version"] <= secret["version"]:
+                    pending["secrets"][key] = secret
+
+            if now - pending["since"] < self.window:
+                return {}, []
+
+            del self._pending[service_id]
+            return pending["env_vars"], list(pending["secrets"].values())
+
+    @staticmethod
+    def _is_new_change(pending: dict, env_vars: dict, secrets: List[dict]) -> bool:
+        if any(pending["env_vars"].get(key) != value for key, value in env_vars.items()):
+            return True
+        return any(
+            (secret["path"], secret["name"]) not in pending["secrets"]
+            or pending["secrets"][(secret["path"], secret["name"])]["version"] < secret["version"]
+            for secret in secrets
+        )
+
+    def discard(self, service_id: str):
+        with self._lock:
+            self._pending.pop(service_id, None)
+
+    def pending(self) -> Dict[str, float]:
+        with self._lock:
+            return {service_id: pending["since"] + self.window for service_id, pending in self._pending.items()}
+
+
+def from_env() -> Coalescer:
+    return Coalescer(window=float(os.environ.get("COALESCE_WINDOW", 0)))
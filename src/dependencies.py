@@ -0,0 +1,102 @@
+import threading
+from collections import defaultdict
+from typing import Iterable, List, Set, Tuple
+
+from docker.models.services import Service as DockerService
+
+import services
+
+
+class DependencyIndex:
+    """Reverse index from Vault (mount_point, path, key) to the IDs of the services labelled with them.
+
+    Root paths of `vault:` labels are indexed separately and match every path below them.
+    A service's labels are only parsed again when its spec version changes.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._bindings = {}
+        self._paths = defaultdict(lambda: defaultdict(set))
+        self._roots = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def update(self, service: DockerService) -> bool:
+        """Index the labels of a service. Returns False if its spec version was already indexed"""
+
+        version = service.attrs.get("Version", {}).get("Index")
+        with self._lock:
+            if service.id in self._versions and self._versions[service.id] == version:
+                return False
+
+        bindings = services.get_service_bindings(service)
+        with self._lock:
+            self._remove(service.id)
+            self._versions[service.id] = version
+            self._bindings[service.id] = bindings
+            for mount_point, path, key in bindings:
+                if key is None:
+                    self._roots[(mount_point, path)].add(service.id)
+                else:
+                    self._paths[(mount_point, path)][key].add(service.id)
+
+        return True
+
+    def _remove(self, service_id: str):
+        self._versions.pop(service_id, None)
+        for mount_point, path, key in self._bindings.pop(service_id, []):
+            if key is None:
+                self._discard(self._roots, (mount_point, path), service_id)
+            else:
+                self._discard(self._paths[(mount_point, path)], key, service_id)
+                if not self._paths[(mount_point, path)]:
+                    del self._paths[(mount_point, path)]
+
+    @staticmethod
+    def _discard(index: dict, key, service_id: str):
+        index[key].discard(service_id)
+        if not index[key]:
+            del index[key]
+
+    def retain(self, service_ids: Iterable[str]):
+        """Drop the services that are no longer in the swarm"""
+
+        service_ids = set(service_ids)
+        with self._lock:
+            for service_id in [service_id for service_id in self._versions if service_id not in service_ids]:
+                self._remove(service_id)
+
+    def paths(self) -> List[Tuple[str, str]]:
+        """The (mount_point, path) of every Vault secret referenced directly by a label"""
+
+        with self._lock:
+            return list(self._paths)
+
+    def roots(self) -> List[Tuple[str, str]]:
+        """The (mount_point, root_path) of every `vault:` label"""
+
+        with self._lock:
+            return list(self._roots)
+
+    def dependents(self, mount_point: str, path: str, key: str = None) -> Set[str]:
+        """Return the IDs of the services that depend on a Vault path, or on a single key of it"""
+
+        with self._lock:
+            dependents = set()
+            for label_key, service_ids in self._paths.get((mount_point, path), {}).items():
+                if key is None or label_key in (key, "all"):
+                    dependents |= service_ids
+
+            for (root_mount_point, root_path), service_ids in self._roots.items():
+                if root_mount_point == mount_point and is_under_path(path, root_path):
+                    dependents |= service_ids
+
+            return dependents
+
+
+def is_under_path(path: str, root_path: str) -> bool:
+    root_path = root_path.strip("/")
+    return not root_path or path.strip("/").startswith(f"{root_path}/")
+
+
+dependency_index = DependencyIndex()
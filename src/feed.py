@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+
+import hvac
+from hvac.exceptions import InvalidPath
+
+import metrics
+import services
+import vault
+from dependencies import dependency_index
+
+
+def feed_enabled() -> bool:
+    """Poll the metadata of referenced Vault paths and reconcile the services of paths that change (CHANGE_FEED)"""
+
+    return os.environ.get("CHANGE_FEED", "false").lower() in ("1", "true", "yes")
+
+
+class ChangeFeed:
+    """Tracks the KV v2 metadata (current_version, updated_time) of Vault paths
+    and reports the paths whose metadata has moved since the last poll.
+    """
+
+    def __init__(self):
+        self._metadata = {}
+        self._lock = threading.Lock()
+
+    def poll(self, client: hvac.Client, paths: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """Read the metadata of the given paths and return those that changed since the last poll.
+        Paths seen for the first time are recorded without being reported and paths no longer given are forgotten.
+        """
+
+        paths = list(paths)
+        max_workers = int(os.environ.get("VAULT_LIST_WORKERS", 8))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="feed") as executor:
+            metadata = list(executor.map(lambda path: read_metadata(client, *path), paths))
+
+        changed = []
+        with self._lock:
+            previous, self._metadata = self._metadata, dict(zip(paths, metadata))
+            for path, current in self._metadata.items():
+                if path in previous and previous[path] != current:
+                    changed.append(path)
+
+        return changed
+
+
+def get_referenced_paths(client: hvac.Client) -> Set[Tuple[str, str]]:
+    """The (mount_point, path) of every Vault secret referenced by a service, including those under `vault:` roots"""
+
+    paths = set(dependency_index.paths())
+    for mount_point, root_path in dependency_index.roots():
+        for path in services.get_all_secrets_under_path(client, root_path, mount_point):
+            paths.add((mount_point, path))
+
+    return paths
+
+
+def read_metadata(client: hvac.Client, mount_point: str, path: str) -> Optional[Tuple[int, str]]:
+    """Read the (current_version, updated_time) of a path directly from Vault, bypassing the metadata cache"""
+
+    try:
+        with metrics.api_call("vault", "read_secret_metadata"):
+            response = client.secrets.kv.v2.read_secret_metadata(path=path, mount_point=mount_point)
+    except InvalidPath:
+        return None
+
+    data = response.get("data", {})
+    return data.get("current_version"), data.get("updated_time")
+
+
+change_feed = ChangeFeed()
+
+
+def start(reconcile: Callable[[Set[str]], None], get_client: Callable[[], hvac.Client]) -> threading.Thread:
+    """Poll the change feed in a background thread"""
+
+    thread = threading.Thread(target=poll_changes, args=(reconcile, get_client), name="change-feed", daemon=True)
+    thread.start()
+    return thread
+
+
+def poll_changes(reconcile: Callable[[Set[str]], None], get_client: Callable[[], hvac.Client]):
+    """Every CHANGE_FEED_INTERVAL seconds, reconcile the services depending on paths that changed"""
+
+    interval = float(os.environ.get("CHANGE_FEED_INTERVAL", 10))
+
+    while True:
+        time.sleep(interval)
+        try:
+            client = get_client()
+            changed = change_feed.poll(client, get_referenced_paths(client))
+        except Exception as error:
+            logging.error(f"Failed to poll Vault metadata: {error}")
+            continue
+
+        if not changed:
+            continue
+
+        service_ids = set()
+        for mount_point, path in changed:
+            logging.info(f"Vault secret changed at: {mount_point}/{path}")
+            vault.secret_cache.invalidate((mount_point, path))
+            vault.metadata_cache.invalidate((mount_point, path))
+            service_ids |= dependency_index.dependents(mount_point, path)
+
+        try:
+            reconcile(service_ids)
+        except Exception:
+            logging.exception("Failed to reconcile services after a Vault change")
@@ -1,50 +1,283 @@
 import os
 import time
 import sys
+from collections import Counter
+from typing import Dict, Set
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from services import *
 import logging
+import cleanup
+import coalesce
+import feed
+import metrics
+import scheduler
+import sharding
+import state
+import tracing
+from dependencies import dependency_index
+import watch
 
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
 
-def main():
-    """MAIN"""
-    vault_url = vault.get_vault_url()
-    client = vault.get_connection(vault_url)
+schedule = scheduler.from_env()
+coalescer = coalesce.from_env()
 
-    services = get_services_with_secrets()
-    for service in services:
+
+@tracing.traced(attributes=("service",))
+def reconcile_service(client: hvac.Client, service: DockerService) -> str:
+    """Read the Vault secrets and envvars a service is labelled with and update the service.
+    Returns "succeeded" if the service was updated or "skipped" if there was nothing to update
+    """
+
+    with get_service_lock(service), metrics.reconcile_duration.time(service=service.name):
         logging.info(f"CHECKING TO UPDATE SECRETS FOR SERVICE: {service.name}")
-        labels = get_service_labels(service)
+        dependency_index.update(service)
+
+        # Execute the compiled label plan of the service, expanding `vault:` roots to every path under them
+        fetches = get_service_fetches(client, service)
+
+        # The fast path: nothing changed since the service was last reconciled
+        versions = get_desired_versions(client, fetches)
+        if is_up_to_date(service, versions):
+            logging.info(f"Service {service.name} is up to date")
+            return SKIPPED
+
         env_vars = {}
         vault_secrets = []
-        for key, label in labels.items():
-            if key.startswith("vault.secrets"):
-                vault_secrets += read_service_secrets(client, service, key, label)
-
-            elif key.startswith("vault.envvars"):
-                env_vars = read_service_envvars(client, service, key, label, env_vars=env_vars)
-
-            elif key.startswith("vault:"):
-                root_path = key.split(":")[1]
-                root_path = "/".join(root_path.split("."))
-
-                # Load all from vault.secrets vault.envvars by recursing paths
-                for mount_point in ["secrets", "envvars"]:
-                    logging.info(f"Scanning vault for secrets on mount_point: {mount_point}")
-                    paths = get_all_secrets_under_path(client, root_path, mount_point, secret_paths=[])
-                    logging.info(f"Found secrets: {paths}")
-                    for path in paths:
-                        if mount_point == "envvars":
-                            env_vars = read_service_envvars(client, service, path, "all", env_vars=env_vars)
-                        elif mount_point == "secrets":
-                            vault_secrets += read_service_secrets(client, service, path, "all")
+        read_versions = {}
+        for fetch in fetches:
+            if fetch.mount_point == "secrets":
+                vault_secrets += read_planned_secrets(client, service, fetch)
+            else:
+                env_vars = read_planned_envvars(client, service, fetch, env_vars, read_versions)
+
+        # Hold back the changes until the coalescing window of the service has passed
+        env_vars = get_changed_environment_variables(service, env_vars)
+        env_vars, vault_secrets = coalescer.submit(service.id, env_vars, vault_secrets)
+
+        # Only fingerprint the service, and count the envvars read as applied, once no changes are held back for it
+        held_back = service.id in coalescer.pending()
+        if held_back:
+            versions = None
 
         # Update the service
-        update_service(service, env_vars, vault_secrets)
+        version = service.attrs.get("Version", {}).get("Index")
+        try:
+            update_service(service, env_vars, vault_secrets, versions)
+        except Exception:
+            forget_applied_versions(service)
+            coalescer.discard(service.id)
+            raise
+
+        if not held_back:
+            record_applied_versions(service, read_versions)
+        return SKIPPED if service.attrs.get("Version", {}).get("Index") == version else SUCCEEDED
+
+
+def reconcile_services(client: hvac.Client, services: List[DockerService]) -> Dict[str, str]:
+    """Reconcile services on a pool of MAX_WORKERS threads. A failing service does not stop the others.
+    Returns the result of each service by service ID
+    """
+
+    results = {}
+    max_workers = int(os.environ.get("MAX_WORKERS", 4))
+    parent = tracing.current()
+
+    def reconcile(service):
+        with tracing.attach(parent):
+            return tracing.profiled(reconcile_service, client, service)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reconcile") as executor:
+        futures = {executor.submit(reconcile, service): service for service in services}
+        for future in as_completed(futures):
+            service = futures[future]
+            try:
+                results[service.id] = future.result()
+            except (hvac.exceptions.Forbidden, hvac.exceptions.Unauthorized):
+                logging.exception(f"Vault refused the token while updating service: {service.name}")
+                vault.get_session().invalidate()
+                results[service.id] = FAILED
+            except Exception:
+                logging.exception(f"Failed to update secrets for service: {service.name}")
+                results[service.id] = FAILED
+
+    return results
+
+
+def summarize(results: Dict[str, str]) -> Counter:
+    return Counter({SUCCEEDED: 0, FAILED: 0, SKIPPED: 0, **Counter(results.values())})
+
+
+def get_shard(services: List[DockerService]) -> List[DockerService]:
+    """The services this replica is responsible for. Keeps the last known membership if it can not be refreshed"""
+
+    try:
+        sharding.shard.refresh()
+    except Exception:
+        if not sharding.shard.members:
+            raise
+        logging.exception("Failed to refresh the shard membership, keeping the last known one")
+
+    services = sharding.shard.filter(services)
+    owned = {service.id for service in services}
+    for service_id in coalescer.pending():
+        if service_id not in owned:
+            coalescer.discard(service_id)
+    retain_applied_versions(owned)
+    return services
+
+
+def is_owned(service_id: str) -> bool:
+    return not sharding.sharding_enabled() or sharding.shard.owns(service_id)
+
+
+def reconcile_event(service: DockerService):
+    """Reconcile a single service reported by the Docker events stream"""
+
+    if not is_owned(service.id):
+        logging.debug(f"Service {service.name} belongs to another replica")
+        return
+
+    client = vault.get_session().client()
+    forget_cycle_reads(client, service)
+    reconcile_service(client, service)
+
+
+def reconcile_changed(service_ids: Set[str]):
+    """Reconcile the services depending on Vault paths reported as changed by the change feed"""
 
-    sleep_length = os.environ.get("INTERVAL", 5 * 60)
-    logging.info(f"Going to sleep for {sleep_length}s")
-    time.sleep(int(sleep_length))
+    client = vault.get_session().client()
+    services = []
+    for service_id in filter(is_owned, service_ids):
+        try:
+            services.append(id_to_service(service_id))
+        except docker.errors.NotFound:
+            logging.info(f"Service {service_id} no longer exists")
+
+    summary = summarize(reconcile_services(client, services))
+    logging.info(
+        f"Reconciled {len(services)} services after Vault changes - succeeded: {summary[SUCCEEDED]}, "
+        f"failed: {summary[FAILED]}, skipped: {summary[SKIPPED]}"
+    )
+
+
+def run_cleanup():
+    """Remove the secrets left behind by rotations once services no longer use them. This lists the whole swarm,
+    so it runs at most once per INTERVAL and, with SHARDING, only on the replica owning a fixed key
+    """
+
+    if not cleanup.cleanup_enabled() or not is_owned(cleanup.OWNER_KEY):
+        return
+    if not cleanup.cleanup_due(schedule.interval):
+        return
+
+    try:
+        cleanup.cleanup()
+    except Exception:
+        logging.exception("Failed to clean up superseded secrets")
+
+
+def main(client: hvac.Client = None) -> Counter:
+    """Run one cycle, traced as a single span tree when TRACE_FILE is set and profiled when PROFILE_DIR is set"""
+
+    with tracing.span("cycle"):
+        summary = tracing.profiled(run_cycle, client)
+
+    if tracing.profiler:
+        tracing.profiler.dump()
+
+    return summary
+
+
+def run_cycle(client: hvac.Client = None) -> Counter:
+    """Reconcile every service with vault labels that the schedule says is due"""
+
+    start = time.perf_counter()
+    client = client or vault.get_session().client()
+    vault.secret_cache.new_cycle()
+    vault.metadata_cache.new_cycle()
+    secret_index.new_cycle()
+    listing_cache.new_cycle()
+    schedule.new_cycle()
+    if state.store:
+        state.store.load(schedule)
+
+    services = get_services_with_secrets()
+    if sharding.sharding_enabled():
+        services = get_shard(services)
+    dependency_index.retain([service.id for service in services])
+    schedule.sync([service.id for service in services])
+    due = set(schedule.due())
+    services = [service for service in services if service.id in due]
+
+    results = reconcile_services(client, services)
+    for service_id, result in results.items():
+        if result == FAILED:
+            schedule.failed(service_id)
+        else:
+            schedule.succeeded(service_id)
+
+    # Come back to services with pending changes as soon as their coalescing window has passed
+    for service_id, release_at in coalescer.pending().items():
+        schedule.defer(service_id, release_at)
+
+    run_cleanup()
+
+    if state.store:
+        try:
+            state.store.save(schedule)
+        except Exception:
+            logging.exception(f"Failed to save the state to: {state.store.path}")
+
+    summary = summarize(results)
+    for result, count in summary.items():
+        metrics.services_reconciled.inc(count, result=result)
+    # Taken here rather than reset by new_cycle, so lookups of event and change feed reconciles are counted too
+    stats = vault.secret_cache.take_stats()
+    metrics.record_cache("vault_secrets", stats)
+    metrics.record_cache("vault_metadata", vault.metadata_cache.take_stats())
+    metrics.record_cache("vault_listing", listing_cache.take_stats())
+    metrics.cycle_duration.observe(time.perf_counter() - start)
+    logging.info(
+        f"Reconciled {len(services)} services - succeeded: {summary[SUCCEEDED]}, "
+        f"failed: {summary[FAILED]}, skipped: {summary[SKIPPED]}"
+    )
+
+    logging.info(f"Vault cache hits: {stats['hits']}, misses: {stats['misses']}, size: {stats['size']}")
+    if coalescer.window > 0:
+        logging.info(f"Rolling updates avoided by coalescing changes: {coalescer.avoided_updates}")
+
+    return summary
+
+
+def run(cycles: int = None):
+    """Run cycles until `cycles` have completed, or forever. Sleeps until the next service is due
+    and backs off exponentially while a whole cycle fails, e.g. because Vault or Docker are unreachable
+    """
+
+    tick = float(os.environ.get("SCHEDULER_TICK", 5))
+    failures = 0
+    counter = 0
+    while cycles is None or counter < cycles:
+        counter += 1
+        try:
+            main()
+            failures = 0
+            next_due = schedule.next_due()
+            sleep_length = max(tick, next_due - time.monotonic()) if next_due is not None else schedule.interval
+        except Exception as error:
+            if isinstance(error, (hvac.exceptions.Forbidden, hvac.exceptions.Unauthorized)):
+                vault.get_session().invalidate()
+            failures += 1
+            sleep_length = min(schedule.backoff * 2 ** (failures - 1), schedule.max_backoff)
+            logging.exception(f"Cycle failed {failures} time(s) in a row")
+
+        if cycles is None or counter < cycles:
+            logging.info(f"Going to sleep for {sleep_length:.0f}s")
+            time.sleep(sleep_length)
 
 
 if __name__ == "__main__":
@@ -52,13 +285,16 @@ if __name__ == "__main__":
     logging.basicConfig(format="%(asctime)s - %(levelname)s - %(filename)s - %(funcName)s - %(message)s",
                         level=getattr(logging, log_level))
 
-    # Loop for a given number of times as specified in sys.argv[1] else forever
-    run_loop = True
-    counter = 1
-    while run_loop:
-        main()
-        # Stop the loop if we are at the correct number of loops
-        if (len(sys.argv) > 2):
-            if (sys.arg[1] >= counter):
-                run_loop = False
-            counter += 1
+    if metrics.metrics_enabled():
+        metrics.start_server()
+
+    # Reconcile services as soon as they change, the loop below is then a slower safety net
+    if watch.watch_enabled():
+        watch.start(reconcile_event)
+
+    # Reconcile services as soon as a Vault path they depend on changes
+    if feed.feed_enabled():
+        feed.start(reconcile_changed, lambda: vault.get_session().client())
+
+    # Run for the number of cycles given in sys.argv[1] (e.g. 1 to run once) else forever
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else None)
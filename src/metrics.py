@@ -0,0 +1,209 @@
+import abc
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metric(abc.ABC):
+    """A metric with a value per combination of label values, rendered in the Prometheus text format"""
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        """The sample lines of the metric, one per combination of label values"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], 0))
+        return sum(counts)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bucket, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bucket == float("inf") else str(bucket)
+                    lines.append(f"{self.name}_bucket{self._format_labels(key, (('le', le),))} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+cycle_duration = Histogram(
+    "vault_swarm_cycle_duration_seconds", "Duration of a reconciliation cycle"
+)
+reconcile_duration = Histogram(
+    "vault_swarm_service_reconcile_duration_seconds", "Duration of the reconciliation of a service", ("service",)
+)
+api_calls = Counter(
+    "vault_swarm_api_calls_total", "Calls made to the Vault and Docker APIs", ("backend", "operation")
+)
+api_errors = Counter(
+    "vault_swarm_api_errors_total", "Calls to the Vault and Docker APIs that raised an error", ("backend", "operation")
+)
+api_call_duration = Histogram(
+    "vault_swarm_api_call_duration_seconds", "Duration of calls to the Vault and Docker APIs", ("backend", "operation")
+)
+cache_requests = Counter(
+    "vault_swarm_cache_requests_total", "Lookups in the read caches by result (hit or miss)", ("cache", "result")
+)
+cache_hit_ratio = Gauge(
+    "vault_swarm_cache_hit_ratio", "Hit ratio of the read caches during the last cycle", ("cache",)
+)
+secrets_created = Counter(
+    "vault_swarm_secrets_created_total", "Docker secrets created from Vault"
+)
+secrets_removed = Counter(
+    "vault_swarm_secrets_removed_total", "Superseded Docker secrets removed by the secret cleanup"
+)
+shard_services = Gauge(
+    "vault_swarm_shard_services", "Services with vault labels this replica is responsible for when SHARDING is enabled"
+)
+services_reconciled = Counter(
+    "vault_swarm_services_total", "Services reconciled by result (succeeded, failed or skipped)", ("result",)
+)
+
+registry = [
+    cycle_duration, reconcile_duration, api_calls, api_errors, api_call_duration, cache_requests, cache_hit_ratio,
+    secrets_created, secrets_removed, shard_services, services_reconciled,
+]
+
+
+@contextmanager
+def api_call(backend: str, operation: str):
+    """Count and time a call to the Vault or Docker API"""
+
+    api_calls.inc(backend=backend, operation=operation)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        api_errors.inc(backend=backend, operation=operation)
+        raise
+    finally:
+        api_call_duration.observe(time.perf_counter() - start, backend=backend, operation=operation)
+
+
+def record_cache(name: str, stats: dict):
+    """Record the hits and misses of a cache since they were last recorded"""
+
+    cache_requests.inc(stats["hits"], cache=name, result="hit")
+    cache_requests.inc(stats["misses"], cache=name, result="miss")
+    lookups = stats["hits"] + stats["misses"]
+    if lookups:
+        cache_hit_ratio.set(stats["hits"] / lookups, cache=name)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics request: {format % args}")
+
+
+def start_server(port: int = None) -> ThreadingHTTPServer:
+    """Serve /metrics on METRICS_PORT in a background thread"""
+
+    port = port if port is not None else int(os.environ.get("METRICS_PORT"))
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on port {port}")
+    return server
+
+
+def metrics_enabled() -> bool:
+    return bool(os.environ.get("METRICS_PORT"))
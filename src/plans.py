@@ -0,0 +1,137 @@
+import logging
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import hvac
+
+import vault
+
+MOUNT_POINTS = ("secrets", "envvars")
+
+
+class PlanError(ValueError):
+    """A vault label that can not be compiled"""
+
+
+class Fetch(NamedTuple):
+    """Read of one Vault secret: every key of it when `key` is None, else `key` stored under `target` (or `key`)"""
+
+    mount_point: str
+    path: str
+    key: Optional[str]
+    target: Optional[str]
+    # The label key or Vault path the fetch comes from, recorded in the labels of the Docker secrets it creates
+    source: str
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.target or self.key
+
+
+class Root(NamedTuple):
+    """Every secret under a Vault path on both mounts, from a `vault:` label"""
+
+    path: str
+
+
+class Plan(NamedTuple):
+    """The compiled vault labels of a service, in label order, and the labels that could not be compiled"""
+
+    steps: Tuple[Union[Fetch, Root], ...]
+    errors: Tuple[str, ...]
+
+    def bindings(self) -> List[Tuple[str, str, Optional[str]]]:
+        """The (mount_point, path, key) of every fetch, with a key of "all" for every key and None for roots"""
+
+        bindings = []
+        for step in self.steps:
+            if isinstance(step, Root):
+                bindings += [(mount_point, step.path, None) for mount_point in MOUNT_POINTS]
+            else:
+                bindings.append((step.mount_point, step.path, step.key or "all"))
+        return bindings
+
+    def expand(self, list_paths: Callable[[str, str], List[str]]) -> List[Fetch]:
+        """The fetches of the plan with roots replaced by a fetch of every path `list_paths(root, mount_point)` finds"""
+
+        fetches = []
+        for step in self.steps:
+            if isinstance(step, Root):
+                for mount_point in MOUNT_POINTS:
+                    paths = list_paths(step.path, mount_point)
+                    fetches += [Fetch(mount_point, path, None, None, path) for path in paths]
+            else:
+                fetches.append(step)
+        return fetches
+
+
+def compile_label(key: str, label: str, mount_point: str = None) -> Fetch:
+    """Compile a `vault.secrets.<path>` or `vault.envvars.<path>` label with a value of `all`, `key` or `key:target`.
+    Keys without a `vault.` prefix are plain paths on `mount_point`
+    """
+
+    if key.startswith("vault."):
+        mount_point = key.split(".")[1]
+        if mount_point not in MOUNT_POINTS or not key[len(f"vault.{mount_point}."):]:
+            raise PlanError(f"{key}={label}: expected vault.secrets.<path> or vault.envvars.<path>")
+
+    label = label.strip()
+    secret_key, separator, target = label.partition(":")
+    if not secret_key or (separator and not target) or ":" in target:
+        raise PlanError(f"{key}={label}: expected all, <key> or <key>:<name>")
+    if secret_key == "all" and separator:
+        raise PlanError(f"{key}={label}: all can not be renamed")
+
+    mount_point, path = vault.resolve_path(key, label, mount_point=mount_point)
+    if not path:
+        raise PlanError(f"{key}={label}: the label has no Vault path")
+
+    if secret_key == "all":
+        return Fetch(mount_point, path, None, None, key)
+    return Fetch(mount_point, path, secret_key, target or None, key)
+
+
+def compile_root(key: str) -> Root:
+    """Compile a `vault:<path>` label"""
+
+    path = "/".join(part for part in key.split(":", 1)[1].split(".") if part)
+    if not path:
+        raise PlanError(f"{key}: expected vault:<path>")
+    return Root(path)
+
+
+def compile_labels(labels: Dict[str, str]) -> Plan:
+    """Compile the vault labels of a service. Other labels are ignored and invalid ones are reported in `errors`"""
+
+    steps, errors = [], []
+    for key, label in labels.items():
+        try:
+            if key.startswith("vault.secrets") or key.startswith("vault.envvars"):
+                steps.append(compile_label(key, label))
+            elif key.startswith("vault:"):
+                steps.append(compile_root(key))
+        except PlanError as error:
+            errors.append(str(error))
+
+    return Plan(tuple(steps), tuple(errors))
+
+
+def read_data(client: hvac.Client, fetch: Fetch) -> Tuple[dict, int]:
+    """Read a fetch through the secret cache. Returns the values by target name and the version read"""
+
+    response = vault.read_secret_version(client, fetch.path, fetch.mount_point).get("data", {})
+    data = response.get("data") or {}
+    version = response.get("metadata", {}).get("version", 0)
+
+    if fetch.key is None:
+        return dict(data), version
+    if fetch.key not in data:
+        logging.error(f"Key {fetch.key} not found in Vault secret: {fetch.mount_point}/{fetch.path}")
+        return {}, version
+    return {fetch.name: data[fetch.key]}, version
+
+
+def read_version(client: hvac.Client, fetch: Fetch) -> int:
+    """Read the current version of a fetch from its metadata, through the metadata cache"""
+
+    response = vault.read_secret_metadata(client, fetch.path, fetch.mount_point)
+    return response.get("data", {}).get("current_version", 0)
@@ -1,10 +1,24 @@
+import json
 import os
+import signal
+import tempfile
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import hvac
+from hvac.exceptions import InvalidPath
 
 import vault
 import logging
-import main
+import services
+
+# Versions of the Vault paths last written to a folder and the files written for each of them
+MANIFEST = ".vault-swarm.json"
+
+# Files are readable by the application whatever user it runs as, as they were before writes became atomic
+FILE_MODE = 0o644
 
 
 def get_or_create_folder(root_path):
@@ -19,13 +33,27 @@ def get_or_create_folder(root_path):
     return path
 
 
+def write_file(file: str, content: str):
+    """Write a file atomically: readers see either the previous or the new content, never a partial file"""
+
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(file), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_file, FILE_MODE)
+        os.replace(temp_file, file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
 def write_envvars(envvars, root_path):
     path = get_or_create_folder(root_path)
     file = f"{path}/envvars"
     logging.info(f"Writing envvars to: {file}")
-    with open(file, 'w') as f:
-        for key, value in envvars.items():
-            f.write(f"{key}={value}\n")
+    write_file(file, "".join(f"{key}={value}\n" for key, value in envvars.items()))
 
 
 def write_secrets(secrets, root_path):
@@ -33,39 +61,199 @@ def write_secrets(secrets, root_path):
     for key, value in secrets.items():
         file = f"{path}/{key}"
         logging.info(f"Writing secret to: {file}")
-        with open(file, 'w') as f:
-            f.write(value)
+        write_file(file, value)
+
+
+def read_manifest(folder: str) -> dict:
+    try:
+        with open(f"{folder}/{MANIFEST}") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(folder: str, manifest: dict):
+    write_file(f"{folder}/{MANIFEST}", json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def read_versions(client: hvac.Client, mount_point: str, paths: List[str], executor) -> Dict[str, Optional[int]]:
+    """Read the current version of every path from its metadata. Paths deleted in the meantime have no version"""
 
+    def read_version(path):
+        try:
+            return vault.read_secret_metadata(client, path, mount_point).get("data", {}).get("current_version")
+        except InvalidPath:
+            return None
 
-def pull(root_path):
+    return dict(zip(paths, executor.map(read_version, paths)))
+
+
+def read_data(client: hvac.Client, mount_point: str, paths: List[str], executor) -> Dict[str, tuple]:
+    """Read the latest (data, version) of every path. Paths deleted in the meantime are left out"""
+
+    def read(path):
+        try:
+            response = vault.read_secret_version(client, path, mount_point).get("data", {})
+        except InvalidPath:
+            return None
+        return dict(response.get("data") or {}), response.get("metadata", {}).get("version", 0)
+
+    return {path: result for path, result in zip(paths, executor.map(read, paths)) if result is not None}
+
+
+def pull(root_path, client: hvac.Client = None) -> List[str]:
     """ Pull all secrets and envvars under vault path down to a local folder in
     /run/secrets/{root_path}/
 
     Note that envvars will be included in the secrets folder as a file named
     "envvars"
+
+    The Vault version of every path is kept in a manifest next to the files, so when
+    the folder was pulled before only the metadata is read and only the files of paths
+    whose version changed are written again. Returns the files written or removed
     """
-    vault_url = vault.get_vault_url()
-    client = vault.get_connection(vault_url)
-
-    envvars = {}
-    secrets = {}
-    for mount_point in ["secrets", "envvars"]:
-        logging.info(f"Scanning vault for secrets on mount_point: {mount_point}")
-        paths = main.get_all_secrets_under_path(client, root_path, mount_point, secret_paths=[])
-        logging.info(f"Found secrets: {paths}")
-        for path in paths:
-            data, version = vault.get_secret_data_version(client, path, "all", mount_point=mount_point)
-            envvars.update(data) if mount_point == "envvars" else secrets.update(data)
-
-    # Write the files
-    write_envvars(envvars, root_path)
-    write_secrets(secrets, root_path)
-    logging.info(f"Done pulling secrets to: {root_path}")
+    client = client or vault.get_session().client()
+    folder = get_or_create_folder(root_path)
+    manifest = read_manifest(folder)
+    vault.secret_cache.new_cycle()
+    vault.metadata_cache.new_cycle()
+    services.listing_cache.new_cycle()
+
+    changed_files = []
+    max_workers = int(os.environ.get("PULL_WORKERS", 8))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pull") as executor:
+        listings = executor.map(
+            lambda mount_point: services.get_all_secrets_under_path(client, root_path, mount_point),
+            ["secrets", "envvars"]
+        )
+        paths = dict(zip(["secrets", "envvars"], listings))
+        logging.info(f"Found secrets: {paths['secrets']} and envvars: {paths['envvars']}")
+
+        # Secrets: one file per key, the last path (in order) wins when several paths have the same key
+        pulled = manifest.get("secrets", {})
+        changed = get_changed_paths(client, "secrets", paths["secrets"], pulled, executor)
+        # Files removed from the folder (e.g. a wiped tmpfs) are written again, as the envvars file is
+        changed += [
+            path for path in paths["secrets"]
+            if path in pulled and path not in changed
+            and not all(os.path.exists(f"{folder}/{file}") for file in pulled[path]["files"])
+        ]
+        data = read_data(client, "secrets", changed, executor)
+        current = {path: pulled[path] for path in paths["secrets"] if path in pulled and path not in changed}
+        current.update({path: {"version": version, "files": sorted(data_)} for path, (data_, version) in data.items()})
+        current = {path: current[path] for path in paths["secrets"] if path in current}
+
+        owners = {file: path for path, entry in current.items() for file in entry["files"]}
+        previous_owners = {file: path for path, entry in pulled.items() for file in entry["files"]}
+        moved = {path for file, path in owners.items() if path not in data and previous_owners.get(file) != path}
+        data.update(read_data(client, "secrets", sorted(moved), executor))
+        secrets = {file: data[path][0][file] for file, path in owners.items() if path in data}
+        write_secrets(secrets, root_path)
+        changed_files += [f"{folder}/{file}" for file in secrets]
+
+        for file in {file for entry in pulled.values() for file in entry["files"]} - set(owners):
+            logging.info(f"Removing secret no longer in Vault: {folder}/{file}")
+            if os.path.exists(f"{folder}/{file}"):
+                os.unlink(f"{folder}/{file}")
+            changed_files.append(f"{folder}/{file}")
+        manifest["secrets"] = current
+
+        # Envvars: a single file, written again from every path when any of them changed
+        pulled = manifest.get("envvars", {})
+        changed = get_changed_paths(client, "envvars", paths["envvars"], pulled, executor)
+        if changed or set(pulled) != set(paths["envvars"]) or not os.path.exists(f"{folder}/envvars"):
+            data = read_data(client, "envvars", paths["envvars"], executor)
+            envvars = {}
+            for path in paths["envvars"]:
+                envvars.update(data.get(path, ({}, 0))[0])
+            write_envvars(envvars, root_path)
+            changed_files.append(f"{folder}/envvars")
+
+            # Paths that could not be read (e.g. soft deleted) are recorded at their metadata version,
+            # so they are not taken for changed on every pull
+            unreadable = [path for path in paths["envvars"] if path not in data]
+            versions = read_versions(client, "envvars", unreadable, executor) if unreadable else {}
+            manifest["envvars"] = {
+                path: {"version": data[path][1] if path in data else versions.get(path)} for path in paths["envvars"]
+            }
+
+    write_manifest(folder, manifest)
+    logging.info(f"Done pulling secrets to: {root_path}, {len(changed_files)} files changed")
+    return changed_files
+
+
+def get_changed_paths(client: hvac.Client, mount_point: str, paths: List[str], pulled: dict, executor) -> List[str]:
+    """The paths that are new or whose version moved since they were last pulled"""
+
+    known = [path for path in paths if path in pulled]
+    versions = read_versions(client, mount_point, known, executor) if known else {}
+    return [path for path in paths if path not in pulled or versions.get(path) != pulled[path]["version"]]
+
+
+def get_notify_signal() -> signal.Signals:
+    """The PULL_NOTIFY_SIGNAL to notify the application with, by name (`SIGHUP` or `HUP`) or number (`1`)"""
+
+    value = os.environ.get("PULL_NOTIFY_SIGNAL", "SIGHUP").strip().upper()
+    try:
+        if value.isdigit():
+            return signal.Signals(int(value))
+        return signal.Signals[value if value.startswith("SIG") else f"SIG{value}"]
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid PULL_NOTIFY_SIGNAL: {value}") from None
+
+
+def notify(changed_files: List[str], signal_: signal.Signals = None):
+    """Tell the application its files changed: send PULL_NOTIFY_SIGNAL to the process in PULL_NOTIFY_PID
+    (or the PID read from PULL_NOTIFY_PID_FILE) and touch the PULL_SENTINEL file
+    """
+
+    pid = os.environ.get("PULL_NOTIFY_PID")
+    pid_file = os.environ.get("PULL_NOTIFY_PID_FILE")
+    if pid_file and os.path.exists(pid_file):
+        with open(pid_file) as f:
+            pid = f.read().strip()
+
+    if pid:
+        signal_ = signal_ or get_notify_signal()
+        try:
+            os.kill(int(pid), signal_)
+            logging.info(f"Sent {signal_.name} to process {pid} after {len(changed_files)} files changed")
+        except ProcessLookupError:
+            logging.warning(f"Could not notify process {pid}, it is not running")
+
+    sentinel = os.environ.get("PULL_SENTINEL")
+    if sentinel:
+        with open(sentinel, "a"):
+            os.utime(sentinel)
+        logging.info(f"Touched {sentinel} after {len(changed_files)} files changed")
+
+
+def watch(root_path, client: hvac.Client = None):
+    """Keep /run/secrets/{root_path} in sync as a sidecar: pull every PULL_INTERVAL seconds,
+    which only reads metadata unless a path changed, and notify the application of every change
+    """
+
+    interval = float(os.environ.get("PULL_INTERVAL", 30))
+    signal_ = get_notify_signal()
+
+    while True:
+        try:
+            changed_files = pull(root_path, client)
+            if changed_files:
+                notify(changed_files, signal_)
+        except Exception:
+            logging.exception(f"Failed to pull secrets to: {root_path}")
+
+        time.sleep(interval)
+
 
 if __name__ == "__main__":
     log_level = os.environ.get("LOG_LEVEL", "INFO")
     logging.basicConfig(format="%(asctime)s - %(levelname)s - %(filename)s - %(funcName)s - %(message)s",
                         level=getattr(logging, log_level))
 
-    # Loop for a given number of times as specified in sys.argv[1] else forever
-    pull(*sys.argv[1:])
+    # `python pull.py <root path>` pulls once, `python pull.py <root path> --watch` keeps the folder in sync
+    if "--watch" in sys.argv[1:]:
+        watch(*[arg for arg in sys.argv[1:] if arg != "--watch"])
+    else:
+        pull(*sys.argv[1:])
@@ -0,0 +1,105 @@
+import os
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class Scheduler:
+    """Tracks when each service is next due for reconciliation.
+
+    A service that reconciled successfully is due again after `interval` seconds plus a random jitter of up to
+    `jitter` * `interval`, so several vault-swarm replicas or restarts drift apart instead of hitting Vault in
+    lockstep. A service that failed is retried with an exponential backoff starting at `backoff` seconds and
+    capped at `max_backoff`. The jitter is drawn once per cycle (see `new_cycle`), so the services of a cycle stay
+    due together and keep sharing the reads of a single cycle.
+    """
+
+    def __init__(self, interval: float, jitter: float = 0.1, backoff: float = 10, max_backoff: float = None):
+        self.interval = interval
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_backoff = max_backoff if max_backoff is not None else interval
+        self._due = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+        self.new_cycle()
+
+    def new_cycle(self):
+        """Draw the jitter of the services rescheduled in the coming cycle"""
+
+        self._jitter_fraction = random.uniform(0, self.jitter)
+
+    def sync(self, service_ids: Iterable[str], now: float = None):
+        """Schedule new services to run right away and forget services that are gone"""
+
+        now = time.monotonic() if now is None else now
+        service_ids = set(service_ids)
+        with self._lock:
+            for service_id in service_ids - set(self._due):
+                self._due[service_id] = now
+            for service_id in set(self._due) - service_ids:
+                self._due.pop(service_id)
+                self._failures.pop(service_id, None)
+
+    def due(self, now: float = None) -> List[str]:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [service_id for service_id, due in self._due.items() if due <= now]
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            return min(self._due.values(), default=None)
+
+    def succeeded(self, service_id: str, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._failures.pop(service_id, None)
+            self._due[service_id] = now + self.interval + self._jitter(self.interval)
+
+    def failed(self, service_id: str, now: float = None) -> float:
+        """Back off a failed service. Returns the delay until it is retried"""
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            failures = self._failures[service_id] = self._failures.get(service_id, 0) + 1
+            delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+            delay += self._jitter(delay)
+            self._due[service_id] = now + delay
+        return delay
+
+    def defer(self, service_id: str, until: float):
+        """Make a service due no later than `until`"""
+
+        with self._lock:
+            if service_id in self._due:
+                self._due[service_id] = min(self._due[service_id], until)
+
+    def dump(self) -> Dict[str, float]:
+        """When each service is due, as a wall clock time"""
+
+        offset = time.time() - time.monotonic()
+        with self._lock:
+            return {service_id: due + offset for service_id, due in self._due.items()}
+
+    def load(self, due: Dict[str, float]):
+        """Restore when services are due from `dump`, e.g. after a restart, for services not scheduled yet"""
+
+        offset = time.time() - time.monotonic()
+        with self._lock:
+            for service_id, wall_time in due.items():
+                self._due.setdefault(service_id, wall_time - offset)
+
+    def _jitter(self, delay: float) -> float:
+        return self._jitter_fraction * delay
+
+
+def from_env() -> Scheduler:
+    """Create a scheduler configured from the environment"""
+
+    return Scheduler(
+        interval=float(os.environ.get("INTERVAL", 5 * 60)),
+        jitter=float(os.environ.get("INTERVAL_JITTER", 0.1)),
+        backoff=float(os.environ.get("BACKOFF", 10)),
+        max_backoff=float(os.environ.get("MAX_BACKOFF", os.environ.get("INTERVAL", 5 * 60))),
+    )
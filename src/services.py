@@ -1,6 +1,12 @@
 import datetime
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Set, Tuple
 
 import docker
 import hvac
@@ -11,21 +17,149 @@ import logging
 
 from hvac.exceptions import InvalidPath
 
+import cache
+import metrics
+import plans
+import tracing
 import vault
 
+# Vault folder walks keyed by (mount_point, path), shared by every service labelled with the same root path
+listing_cache = cache.from_env("VAULT_LIST")
+
+# Envvar version applied for each (service ID, fetch) and the spec version of the service it was applied at,
+# used when VAULT_METADATA_FIRST is enabled. A spec changed by anyone else (e.g. a redeploy) reads the envvars again
+applied_versions = {}
+
+
+# Digest of the spec each service was left with by our own service.update(), see is_own_update
+own_specs = {}
+
+# Service label holding the fingerprint of the state a service was last reconciled to, see get_fingerprint
+FINGERPRINT_LABEL = "build.procedural.vault-swarm.fingerprint"
+
+# One lock per service ID so a service is never reconciled by two threads at once
+service_locks = defaultdict(threading.Lock)
+_service_locks_lock = threading.Lock()
+
+# Long-lived Docker client shared by every call in this module (see get_docker_client)
+docker_client = None
+_docker_client_lock = threading.Lock()
 
-def id_to_service(service: Union[DockerService, str]) -> DockerService:
+
+def get_docker_client() -> docker.DockerClient:
+    """Return the shared Docker client, creating it on first use with a DOCKER_POOL_SIZE connection pool"""
+
+    global docker_client
+    with _docker_client_lock:
+        if docker_client is None:
+            pool_size = int(os.environ.get("DOCKER_POOL_SIZE", 10))
+            docker_client = docker.from_env(max_pool_size=pool_size)
+        return docker_client
+
+
+def set_docker_client(client: Optional[docker.DockerClient]):
+    """Replace the shared Docker client, e.g. with a client for tests. None resets to the default client"""
+
+    global docker_client
+    with _docker_client_lock:
+        docker_client = client
+
+
+class SecretIndex:
+    """Per-cycle index of the Docker secrets in the swarm, keyed by ID and by their (name, version, path) labels.
+
+    The index is built from a single `client.secrets.list()` the first time it is used in a cycle
+    and is kept up to date in place as secrets are created and removed. Docker secrets can not be changed,
+    so the labels of the secrets seen are also kept across cycles and looked up without building the index.
+    """
+
+    def __init__(self):
+        self._by_labels = None
+        self._by_id = None
+        self._secrets = None
+        self._known_labels = {}
+        self.lock = threading.RLock()
+
+    def new_cycle(self):
+        with self.lock:
+            self._by_labels = self._by_id = self._secrets = None
+
+    def build(self, client):
+        with self.lock:
+            if self._by_labels is None:
+                self._by_labels = {}
+                self._by_id = {}
+                self._secrets = {}
+                with metrics.api_call("docker", "secrets.list"):
+                    secrets = client.secrets.list()
+                for secret in secrets:
+                    self.add(secret)
+                self._known_labels = dict(self._by_id)
+
+    def add(self, secret: DockerSecret):
+        with self.lock:
+            labels = get_secret_labels(secret)
+            self._known_labels[secret.id] = labels
+            if self._by_labels is None:
+                return
+            self._by_labels[(labels.get("name"), labels.get("version"), labels.get("path"))] = secret
+            self._by_id[secret.id] = labels
+            self._secrets[secret.id] = secret
+
+    def remove(self, secret_id: str):
+        with self.lock:
+            self._known_labels.pop(secret_id, None)
+            if self._secrets is None or self._secrets.pop(secret_id, None) is None:
+                return
+            del self._by_id[secret_id]
+            self._by_labels = {key: secret for key, secret in self._by_labels.items() if secret.id != secret_id}
+
+    def secrets(self, client) -> List[DockerSecret]:
+        with self.lock:
+            self.build(client)
+            return list(self._secrets.values())
+
+    def labels(self, client, secret_id: str) -> Optional[dict]:
+        with self.lock:
+            if secret_id in self._known_labels:
+                return self._known_labels[secret_id]
+            self.build(client)
+            return self._by_id.get(secret_id)
+
+    def known_labels(self) -> dict:
+        with self.lock:
+            return dict(self._known_labels)
+
+    def load_labels(self, labels: dict):
+        """Add the labels of secrets seen before, e.g. by a previous run"""
+
+        with self.lock:
+            for secret_id, labels_ in labels.items():
+                self._known_labels.setdefault(secret_id, labels_)
+
+    def find(self, client, secret_name: str, version: int, vault_path: str) -> Optional[DockerSecret]:
+        with self.lock:
+            self.build(client)
+            return self._by_labels.get((secret_name, str(version), vault_path))
+
+
+secret_index = SecretIndex()
+
+
+def id_to_service(service: Union[DockerService, str], client: docker.DockerClient = None) -> DockerService:
     if isinstance(service, str):
-        client = docker.from_env()
-        return client.services.get(service)
+        client = client or get_docker_client()
+        with metrics.api_call("docker", "services.inspect"):
+            return client.services.get(service)
     else:
         return service
 
 
-def id_to_secret(secret: Union[DockerSecret, str]) -> DockerSecret:
+def id_to_secret(secret: Union[DockerSecret, str], client: docker.DockerClient = None) -> DockerSecret:
     if isinstance(secret, str):
-        client = docker.from_env()
-        return client.secrets.get(secret)
+        client = client or get_docker_client()
+        with metrics.api_call("docker", "secrets.inspect"):
+            return client.secrets.get(secret)
     else:
         return secret
 
@@ -36,81 +170,305 @@ def get_service_labels(service: Union[DockerService, str]) -> dict:
     return service.attrs["Spec"]["Labels"]
 
 
-def get_all_secrets_under_path(client, path, mount_point, secret_paths=[]):
+@tracing.traced(attributes=("path", "mount_point"))
+def get_all_secrets_under_path(client: hvac.Client, path: str, mount_point: str) -> List[str]:
+    """Return all secret paths under a Vault folder. Walks are cached per cycle and shared between services"""
+
+    return listing_cache.get_or_load(
+        (mount_point, path), lambda: list_secrets_under_path(client, path, mount_point)
+    )
+
+
+def list_secrets_under_path(client: hvac.Client, path: str, mount_point: str) -> List[str]:
+    """Walk a Vault folder breadth-first, listing every folder of a level concurrently"""
+
     logging.info(f"Searching for secrets on path: {path}, mount_point: {mount_point}")
-    response = client.secrets.kv.v2.list_secrets(path=path, mount_point=mount_point)
-    keys = response.get("data", {}).get("keys", [])
-    _path = path[:-1] if path.endswith("/") else path
-    for key in keys:
-        if key.endswith('/'):
-            secret_paths += get_all_secrets_under_path(
-                client, f"{_path}/{key}", mount_point, secret_paths=secret_paths
-            )
-        else:
-            logging.info(f" - Found secret: {_path}/{key}")
-            secret_paths += [f"{_path}/{key}"]
-    return secret_paths
+    max_workers = int(os.environ.get("VAULT_LIST_WORKERS", 8))
+    secret_paths = set()
+    folders = [path[:-1] if path.endswith("/") else path]
+    parent = tracing.current()
+
+    def list_keys(folder):
+        with tracing.attach(parent):
+            return list_secret_keys(client, folder, mount_point)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="list") as executor:
+        while folders:
+            listings = executor.map(list_keys, folders)
+            sub_folders = []
+            for folder, keys in zip(folders, listings):
+                for key in keys:
+                    if key.endswith("/"):
+                        sub_folders.append(f"{folder}/{key[:-1]}")
+                    else:
+                        logging.debug(f" - Found secret: {folder}/{key}")
+                        secret_paths.add(f"{folder}/{key}")
+            folders = sub_folders
+
+    return sorted(secret_paths)
+
+
+def list_secret_keys(client: hvac.Client, path: str, mount_point: str) -> List[str]:
+    try:
+        with metrics.api_call("vault", "list_secrets"):
+            response = client.secrets.kv.v2.list_secrets(path=path, mount_point=mount_point)
+    except InvalidPath:
+        logging.debug(f"No secrets on path: {path}, mount_point: {mount_point}")
+        return []
+
+    return response.get("data", {}).get("keys", [])
 
 
 def read_service_secrets(client: hvac.Client, service: DockerService, key: str, label: str) -> List[dict]:
+    return read_planned_secrets(client, service, plans.compile_label(key, label, mount_point="secrets"))
+
+
+def read_service_envvars(client, service, key, label, env_vars=None):
+    fetch = plans.compile_label(key, label, mount_point="envvars")
+    return read_planned_envvars(client, service, fetch, env_vars if env_vars is not None else {})
+
+
+def read_planned_secrets(client: hvac.Client, service: DockerService, fetch: plans.Fetch) -> List[dict]:
+    """Execute a fetch of secrets. Returns the secrets to create, none if the service has the latest version"""
+
     logging.info(f"Found vault secrets label on service: {service.name} - ID: {service.short_id}")
-    vault_secrets = []
+    secrets = get_service_secrets(service)
+    secret_version = get_docker_secret_version(secrets, fetch.name or "all", fetch.source)
 
-    logging.info(f"Getting secret data version: {key}, {label}")
+    logging.info(f"Getting secret data version: {fetch.mount_point}/{fetch.path}, {fetch.key or 'all'}")
     try:
-        data, version = vault.get_secret_data_version(client, key, label, mount_point="secrets")
+        if vault.metadata_first():
+            version = plans.read_version(client, fetch)
+            if secret_version and version <= secret_version:
+                logging.debug(f"Secret {fetch.source} is unchanged at version {version}")
+                return []
+        data, version = plans.read_data(client, fetch)
     except InvalidPath:
-        logging.error(f"Could not find Vault secret at: {key}={label}")
+        logging.error(f"Could not find Vault secret at: {fetch.mount_point}/{fetch.path}")
         return []
 
-    secrets = get_service_secrets(service)
-    secret_version = get_docker_secret_version(secrets, label, key)
-
-    if not secret_version or (version > secret_version):
-        if label == "all":
-            vault_secrets.extend(
-                [
-                    {"data": value, "version": version, "name": data_key, "path": key}
-                    for data_key, value in data.items()
-                ]
-            )
-        else:
-            if ":" in label:
-                _, label = label.split(":")
+    if secret_version and version <= secret_version:
+        return []
 
-            vault_secrets.append({"data": data[label], "version": version, "name": label, "path": key})
+    return [
+        {"data": value, "version": version, "name": name, "path": fetch.source}
+        for name, value in data.items()
+    ]
 
-    return vault_secrets
 
+def read_planned_envvars(client: hvac.Client, service: DockerService, fetch: plans.Fetch, env_vars: dict,
+                         read_versions: dict = None) -> dict:
+    """Execute a fetch of envvars, adding them to `env_vars` and the version read to `read_versions`.
+    The versions only count as applied once recorded with record_applied_versions
+    """
 
-def read_service_envvars(client, service, key, label, env_vars={}):
     logging.info(f"Found vault envvars label on service: {service.name} - ID: {service.short_id}")
 
     try:
-        env_, _ = vault.get_secret_data_version(client, key, label, mount_point="envvars")
+        if vault.metadata_first():
+            version = plans.read_version(client, fetch)
+            if applied_versions.get((service.id, fetch)) == (version, get_spec_version(service)):
+                logging.debug(f"Envvars {fetch.source} are unchanged at version {version}")
+                return env_vars
+        env_, version = plans.read_data(client, fetch)
         env_vars.update(**env_)
+        if read_versions is not None:
+            read_versions[fetch] = version
     except InvalidPath:
-        logging.error(f"Could not find Vault secret at: {key}={label}")
-        pass
+        logging.error(f"Could not find Vault secret at: {fetch.mount_point}/{fetch.path}")
 
     return env_vars
 
 
-def get_services_with_secrets() -> List[DockerService]:
+def record_applied_versions(service: DockerService, read_versions: dict):
+    """Record the envvar versions a service was updated with, at the spec version the update left"""
+
+    for fetch, version in read_versions.items():
+        applied_versions[(service.id, fetch)] = (version, get_spec_version(service))
+
+
+def forget_applied_versions(service: DockerService):
+    """Forget the envvar versions read for a service, so they are read in full on the next cycle"""
+
+    for applied in list(applied_versions):
+        if applied[0] == service.id:
+            applied_versions.pop(applied, None)
+
+
+def retain_applied_versions(service_ids: Set[str]):
+    """Forget the envvar versions read for every other service, e.g. services handed over to another replica"""
+
+    for applied in list(applied_versions):
+        if applied[0] not in service_ids:
+            applied_versions.pop(applied, None)
+
+
+def move_applied_versions(service_id: str, spec_version: Optional[int], new_spec_version: Optional[int]):
+    """Carry the envvar versions read at a spec version over to the spec version our own update left"""
+
+    for applied, (version, spec_version_) in list(applied_versions.items()):
+        if applied[0] == service_id and spec_version_ == spec_version:
+            applied_versions[applied] = (version, new_spec_version)
+
+
+class LabelCache:
+    """The vault labels of every service and their compiled plan, compiled again only when the service's spec
+    version changes. Invalid labels are logged once per spec version
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, service: DockerService) -> Tuple[dict, plans.Plan]:
+        version = service.attrs.get("Version", {}).get("Index")
+        with self._lock:
+            cached = self._entries.get(service.id)
+            if cached and cached[0] == version:
+                return cached[1:]
+
+        labels = {key: label for key, label in get_service_labels(service).items() if key.startswith("vault")}
+        plan = plans.compile_labels(labels)
+        for error in plan.errors:
+            logging.error(f"Invalid vault label on service {service.name}: {error}")
+
+        with self._lock:
+            self._entries[service.id] = (version, labels, plan)
+        return labels, plan
+
+    def get(self, service: DockerService) -> dict:
+        return self._entry(service)[0]
+
+    def plan(self, service: DockerService) -> plans.Plan:
+        return self._entry(service)[1]
+
+    def retain(self, service_ids: List[str]):
+        service_ids = set(service_ids)
+        with self._lock:
+            self._entries = {
+                service_id: cached for service_id, cached in self._entries.items() if service_id in service_ids
+            }
+
+
+label_cache = LabelCache()
+
+
+def get_service_filters() -> Optional[dict]:
+    """Docker filters for the services to list. SERVICE_LABEL_FILTER holds comma separated `key` or `key=value`
+    labels a service must all have, so the other services are filtered out by Docker instead of being listed
+    """
+
+    labels = [label.strip() for label in os.environ.get("SERVICE_LABEL_FILTER", "").split(",") if label.strip()]
+    return {"label": labels} if labels else None
+
+
+@tracing.traced()
+def get_services_with_secrets(client: docker.DockerClient = None) -> List[DockerService]:
     """Returns Docker services with labels that starts with 'vault.'"""
 
-    client = docker.from_env()
+    client = client or get_docker_client()
 
-    services = client.services.list()
-    services = [
-        service
-        for service in services
-        if any([label.startswith("vault") for label in get_service_labels(service).keys()])
-    ]
+    with metrics.api_call("docker", "services.list"):
+        services = client.services.list(filters=get_service_filters())
+    label_cache.retain([service.id for service in services])
+    services = [service for service in services if has_vault_labels(service)]
 
     return services
 
 
+def get_service_bindings(service: DockerService) -> List[Tuple[str, str, Optional[str]]]:
+    """Return the (mount_point, path, key) of every Vault secret a service is labelled with.
+    Root paths from `vault:` labels are returned with a key of None
+    """
+
+    return label_cache.plan(service).bindings()
+
+
+def get_service_fetches(client: hvac.Client, service: DockerService) -> List[plans.Fetch]:
+    """The fetches of a service's plan, with `vault:` roots expanded to every secret under them"""
+
+    return label_cache.plan(service).expand(
+        lambda root_path, mount_point: get_all_secrets_under_path(client, root_path, mount_point)
+    )
+
+
+def forget_cycle_reads(client: hvac.Client, service: DockerService):
+    """Drop the reads of a service's Vault paths kept for the current cycle only, so a reconcile between cycles
+    (e.g. after a Docker event) sees Vault as it is now rather than as the last cycle saw it
+    """
+
+    for step in label_cache.plan(service).steps:
+        if isinstance(step, plans.Root):
+            for mount_point in plans.MOUNT_POINTS:
+                listing_cache.forget_cycle((mount_point, step.path))
+
+    for fetch in get_service_fetches(client, service):
+        vault.secret_cache.forget_cycle((fetch.mount_point, fetch.path))
+        vault.metadata_cache.forget_cycle((fetch.mount_point, fetch.path))
+
+
+def has_vault_labels(service: Union[DockerService, str]) -> bool:
+    return bool(label_cache.get(id_to_service(service)))
+
+
+def get_service_lock(service: Union[DockerService, str]) -> threading.Lock:
+    service_id = service if isinstance(service, str) else service.id
+    with _service_locks_lock:
+        return service_locks[service_id]
+
+
+def get_spec_version(service: DockerService) -> Optional[int]:
+    return service.attrs.get("Version", {}).get("Index")
+
+
+def get_spec_digest(service: DockerService) -> str:
+    spec = json.dumps(service.attrs.get("Spec", {}), sort_keys=True)
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+
+def is_own_update(service: DockerService) -> bool:
+    """Whether the service spec is still the one our own update_service() left it with"""
+
+    return own_specs.get(service.id) == get_spec_digest(service)
+
+
+def get_desired_versions(client: hvac.Client, fetches: List[plans.Fetch]) -> List[tuple]:
+    """Return the (mount_point, path, key, target, version) of every fetch of a service.
+    Versions come from the same cached reads (or metadata reads with VAULT_METADATA_FIRST) as the reconciliation
+    """
+
+    def get_version(fetch):
+        try:
+            if vault.metadata_first():
+                return plans.read_version(client, fetch)
+            return plans.read_data(client, fetch)[1]
+        except InvalidPath:
+            return None
+
+    return sorted({fetch[:4] + (get_version(fetch),) for fetch in fetches}, key=str)
+
+
+def get_fingerprint(versions: List[tuple], env: List[str], secrets: List[dict]) -> str:
+    """Hash of the Vault versions a service is reconciled to and of the env and secrets it is left with.
+    The env and secrets are part of it so a service changed by hand is not mistaken for an unchanged one
+    """
+
+    state = {
+        "versions": versions,
+        "env": sorted(env or []),
+        "secrets": sorted(secret["SecretID"] for secret in secrets or []),
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def is_up_to_date(service: DockerService, versions: List[tuple]) -> bool:
+    """Whether the service was last reconciled to these versions and its env and secrets were not changed since"""
+
+    container_spec = service.attrs["Spec"].get("TaskTemplate", {}).get("ContainerSpec", {})
+    fingerprint = get_fingerprint(versions, container_spec.get("Env"), container_spec.get("Secrets"))
+    return get_service_labels(service).get(FINGERPRINT_LABEL) == fingerprint
+
+
 def get_service_secrets(service: Union[DockerService, str]):
     service = id_to_service(service)
 
@@ -118,6 +476,7 @@ def get_service_secrets(service: Union[DockerService, str]):
     return secrets
 
 
+@tracing.traced(attributes=("name", "path"))
 def get_docker_secret_version(secrets: List[dict], name: str, path: str) -> Optional[int]:
     if not secrets:
         return None
@@ -130,6 +489,8 @@ def get_docker_secret_version(secrets: List[dict], name: str, path: str) -> Opti
             if path == secret_labels.get("path"):
                 return int(secret_labels.get("version", 0))
 
+    # Secrets of a `key:filename` label are named after the file
+    name = name.split(":")[-1].split("/")[-1]
     for secret in secrets:
         if secret.get("SecretName", "").startswith(name):
             secret_id = secret.get("SecretID")
@@ -141,39 +502,52 @@ def get_docker_secret_version(secrets: List[dict], name: str, path: str) -> Opti
     return None
 
 
-def get_secret_labels(secret: Union[DockerSecret, str]) -> dict:
-    secret = id_to_secret(secret)
+def get_secret_labels(secret: Union[DockerSecret, str], client: docker.DockerClient = None) -> dict:
+    if isinstance(secret, str):
+        client = client or get_docker_client()
+        labels = secret_index.labels(client, secret)
+        if labels is not None:
+            return labels
+
+    secret = id_to_secret(secret, client)
     if secret:
         return secret.attrs["Spec"].get("Labels", {})
     else:
         return {}
 
 
-def create_secret(secret_data: bytes, secret_name: str, version: int, vault_path: str, stack: str) -> DockerSecret:
+@tracing.traced(attributes=("secret_name", "version", "vault_path"))
+def create_secret(secret_data: bytes, secret_name: str, version: int, vault_path: str, stack: str,
+                  client: docker.DockerClient = None) -> DockerSecret:
     """Create a Docker Secret"""
 
-    client = docker.from_env()
+    client = client or get_docker_client()
     name = create_secret_name(secret_name, vault_path)
     vault_path = vault_path.replace(".", "/")
 
     logging.info(f"Creating secret for {secret_name} with Docker name: {name}")
-    existing_secret = get_existing_secrets(client, secret_name, version, vault_path)
-
-    if existing_secret:
-        logging.debug(f"Found existing secret for {name}")
-        return existing_secret
-
-    secret = client.secrets.create(
-        name=name,
-        data=secret_data,
-        labels={
-            "version": str(version),
-            "path": vault_path,
-            "name": secret_name,
-            "com.docker.stack.namespace": stack,
-        },
-    )
-    secret.reload()
+    with secret_index.lock:
+        existing_secret = get_existing_secrets(client, secret_name, version, vault_path)
+
+        if existing_secret:
+            logging.debug(f"Found existing secret for {name}")
+            return existing_secret
+
+        with metrics.api_call("docker", "secrets.create"):
+            secret = client.secrets.create(
+                name=name,
+                data=secret_data,
+                labels={
+                    "version": str(version),
+                    "path": vault_path,
+                    "name": secret_name,
+                    "com.docker.stack.namespace": stack,
+                },
+            )
+        with metrics.api_call("docker", "secrets.inspect"):
+            secret.reload()
+        secret_index.add(secret)
+        metrics.secrets_created.inc()
 
     return secret
 
@@ -186,12 +560,9 @@ def create_secret_name(name: str, path: str):
     return f"{name}{_path}{_time}"
 
 
+@tracing.traced(attributes=("secret_name", "version", "vault_path"))
 def get_existing_secrets(client, secret_name: str, version: int, vault_path: str) -> Optional[DockerSecret]:
-    secrets = client.secrets.list()
-
-    for secret in secrets:
-        if {secret_name, str(version), vault_path} <= set(get_secret_labels(secret).values()):
-            return secret
+    return secret_index.find(client, secret_name, version, vault_path)
 
 
 def get_service_environment_variables(service: DockerService) -> dict:
@@ -221,6 +592,13 @@ def prepare_environment_variables(service: DockerService, vault_env: dict) -> li
         return convert_dict_to_env_list(new_env)
 
 
+def get_changed_environment_variables(service: DockerService, vault_env: dict) -> dict:
+    """Return the Vault env vars whose value differs from the one set on the service"""
+
+    env_vars = get_service_environment_variables(service)
+    return {key: value for key, value in vault_env.items() if env_vars.get(key) != value}
+
+
 def prepare_secrets(vault_secrets: List[dict], stack: str) -> List[SecretReference]:
     new_secrets = []
     for secret in vault_secrets:
@@ -234,11 +612,32 @@ def prepare_secrets(vault_secrets: List[dict], stack: str) -> List[SecretReferen
     return new_secrets
 
 
-def update_service(service: DockerService, env_vars: dict, secrets: List[dict]) -> DockerService:
-    """Bulk update a Docker service with new environment variables and secrets"""
+def merge_secret_references(service: DockerService, new_secrets: List[SecretReference]) -> List[SecretReference]:
+    """Keep the secrets already attached to a service unless a new secret replaces their file"""
+
+    filenames = {secret["File"]["Name"] for secret in new_secrets}
+    secrets = [
+        SecretReference(
+            secret["SecretID"], secret["SecretName"], filename=secret.get("File", {}).get("Name"),
+            uid=secret.get("File", {}).get("UID"), gid=secret.get("File", {}).get("GID"),
+            mode=secret.get("File", {}).get("Mode", 0o444)
+        )
+        for secret in get_service_secrets(service) or []
+        if secret.get("File", {}).get("Name") not in filenames
+    ]
+    return secrets + new_secrets
+
+
+@tracing.traced(attributes=("service",))
+def update_service(service: DockerService, env_vars: dict, secrets: List[dict],
+                   versions: List[tuple] = None) -> DockerService:
+    """Bulk update a Docker service with new environment variables and secrets.
+    When the Vault versions the service is reconciled to are given, its fingerprint label is updated with them
+    """
 
     new_environment = new_secrets = None
-    stack = service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Labels"]["com.docker.stack.namespace"]
+    container_spec = service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]
+    stack = container_spec["Labels"]["com.docker.stack.namespace"]
 
     if env_vars:
         new_environment = prepare_environment_variables(service, env_vars)
@@ -246,20 +645,43 @@ def update_service(service: DockerService, env_vars: dict, secrets: List[dict])
     if secrets:
         new_secrets = prepare_secrets(secrets, stack)
 
+    if new_secrets:
+        new_secrets = merge_secret_references(service, new_secrets)
+
+    changes = {}
+    if new_environment:
+        changes["env"] = new_environment
+    if new_secrets:
+        changes["secrets"] = new_secrets
+    if versions is not None:
+        labels = get_service_labels(service)
+        fingerprint = get_fingerprint(
+            versions, new_environment or container_spec.get("Env"), new_secrets or container_spec.get("Secrets")
+        )
+        if labels.get(FINGERPRINT_LABEL) != fingerprint:
+            changes["labels"] = {**labels, FINGERPRINT_LABEL: fingerprint}
+
+    if not changes:
+        logging.info(f"Nothing updated for service: {service.short_id}")
+        return service
+
+    spec_version = get_spec_version(service)
+    with metrics.api_call("docker", "services.update"):
+        service.update(**changes)
     if new_environment and new_secrets:
-        service.update(env=new_environment, secrets=new_secrets)
         logging.info(
             f"Updated environment variables: {', '.join(env_vars.keys())} and "
             f"secrets: {', '.join([s['name'] for s in secrets])} for service: {service.short_id}"
         )
     elif new_environment:
-        service.update(env=new_environment)
         logging.info(f"Updated environment variables: {', '.join(env_vars.keys())} for service: {service.short_id}")
     elif new_secrets:
-        service.update(secrets=new_secrets)
         logging.info(f"Updated secrets: {', '.join([s['name'] for s in secrets])} for service: {service.short_id}")
     else:
-        logging.info(f"Nothing updated for service: {service.short_id}")
+        logging.info(f"Updated fingerprint for service: {service.short_id}")
 
-    service.reload()
+    with metrics.api_call("docker", "services.inspect"):
+        service.reload()
+    own_specs[service.id] = get_spec_digest(service)
+    move_applied_versions(service.id, spec_version, get_spec_version(service))
     return service
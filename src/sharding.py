@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+import docker
+from docker.models.services import Service as DockerService
+
+import metrics
+import services
+
+
+def sharding_enabled() -> bool:
+    """Split the services with vault labels between the replicas of the vault-swarm service (SHARDING)"""
+
+    return os.environ.get("SHARDING", "false").lower() in ("1", "true", "yes")
+
+
+def score(member: str, service_id: str) -> int:
+    return int.from_bytes(hashlib.sha256(f"{member}/{service_id}".encode()).digest()[:8], "big")
+
+
+def owner(service_id: str, members: Iterable[str]) -> Optional[str]:
+    """The member a service belongs to, by rendezvous hashing: when a member joins or leaves,
+    only the services it gains or loses move
+    """
+
+    return max(members, key=lambda member: score(member, service_id), default=None)
+
+
+def get_own_task(client: docker.DockerClient) -> Tuple[str, str]:
+    """The (service ID, task ID) of this replica, from SHARD_SERVICE_ID and SHARD_TASK_ID (set them to
+    `{{.Service.ID}}` and `{{.Task.ID}}`), else from the swarm labels of the container named by HOSTNAME
+    """
+
+    if os.environ.get("SHARD_SERVICE_ID") and os.environ.get("SHARD_TASK_ID"):
+        return os.environ["SHARD_SERVICE_ID"], os.environ["SHARD_TASK_ID"]
+
+    with metrics.api_call("docker", "containers.inspect"):
+        container = client.containers.get(os.environ["HOSTNAME"])
+    labels = container.labels
+    return labels["com.docker.swarm.service.id"], labels["com.docker.swarm.task.id"]
+
+
+def get_members(client: docker.DockerClient, service_id: str) -> List[str]:
+    """The IDs of the running tasks of the vault-swarm service"""
+
+    with metrics.api_call("docker", "tasks.list"):
+        tasks = client.api.tasks(filters={"service": service_id, "desired-state": "running"})
+    return sorted(task["ID"] for task in tasks if task.get("Status", {}).get("State") == "running")
+
+
+class Shard:
+    """The services with vault labels this replica is responsible for.
+
+    Membership is the set of running tasks of the vault-swarm service, refreshed every cycle, and every service
+    belongs to one member by rendezvous hashing of its ID. Services move between replicas as replicas come and go.
+    """
+
+    def __init__(self):
+        self.service_id = None
+        self.member = None
+        self.members = ()
+        self._lock = threading.Lock()
+
+    def refresh(self, client: docker.DockerClient = None) -> bool:
+        """Refresh the membership. Returns True if it changed"""
+
+        client = client or services.get_docker_client()
+        if self.member is None:
+            self.service_id, self.member = get_own_task(client)
+
+        # This replica may not be reported as running yet while it starts
+        members = tuple(sorted(set(get_members(client, self.service_id)) | {self.member}))
+        with self._lock:
+            changed, self.members = members != self.members, members
+
+        if changed:
+            logging.info(
+                f"Shard membership changed: {len(members)} replicas, this replica is {members.index(self.member) + 1}"
+            )
+        return changed
+
+    def owns(self, service_id: str) -> bool:
+        """Whether a service belongs to this replica. Nothing does until the membership is known"""
+
+        with self._lock:
+            return self.member is not None and owner(service_id, self.members) == self.member
+
+    def filter(self, services_: List[DockerService]) -> List[DockerService]:
+        owned = [service for service in services_ if self.owns(service.id)]
+        metrics.shard_services.set(len(owned))
+        return owned
+
+
+shard = Shard()
@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import plans
+import scheduler
+import services
+import vault
+
+# Bumped whenever the layout of the state file changes, older files are then ignored
+FORMAT = 1
+
+
+def state_enabled() -> bool:
+    return bool(os.environ.get("STATE_FILE"))
+
+
+class StateStore:
+    """Keeps what a cycle learned in STATE_FILE, so a restarted vault-swarm starts warm.
+
+    The file holds when every service is next due, the Vault metadata and folder listings kept across cycles
+    (VAULT_METADATA_CACHE_TTL and VAULT_LIST_CACHE_TTL), the envvar versions applied to every service with the spec
+    version of the service they were applied at and the labels of the Docker secrets seen. It never holds secret
+    values. Cache entries expire when they would have without a restart, and the envvars of a service whose spec
+    changed in the meantime, e.g. redeployed while vault-swarm was down, are read again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def save(self, schedule: scheduler.Scheduler):
+        """Write the state atomically: a crash leaves either the previous or the new file, never a partial one"""
+
+        state = {
+            "format": FORMAT,
+            "saved_at": time.time(),
+            "schedule": schedule.dump(),
+            "vault_metadata": vault.metadata_cache.dump(),
+            "vault_listing": services.listing_cache.dump(),
+            "applied_versions": [
+                [service_id, list(fetch), version, spec_version]
+                for (service_id, fetch), (version, spec_version) in list(services.applied_versions.items())
+            ],
+            "secret_labels": services.secret_index.known_labels(),
+        }
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            fd, temp_file = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "w") as file:
+                    json.dump(state, file, separators=(",", ":"))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_file, self.path)
+            except BaseException:
+                os.unlink(temp_file)
+                raise
+
+    def read(self) -> Optional[dict]:
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return None
+        except ValueError as error:
+            logging.warning(f"Ignoring unreadable state file {self.path}: {error}")
+            return None
+
+        if state.get("format") != FORMAT:
+            logging.warning(f"Ignoring state file {self.path} of format {state.get('format')}")
+            return None
+        return state
+
+    def load(self, schedule: scheduler.Scheduler):
+        """Load the state once, on the first cycle after starting"""
+
+        if self.loaded:
+            return
+        self.loaded = True
+
+        state = self.read()
+        if state is None:
+            return
+
+        # Entries were saved with their time to live at the time of saving
+        elapsed = max(time.time() - state.get("saved_at", 0), 0)
+        metadata = state.get("vault_metadata", [])
+        listing = state.get("vault_listing", [])
+        schedule.load(state.get("schedule", {}))
+        vault.metadata_cache.load([(tuple(key), ttl - elapsed, value) for key, ttl, value in metadata])
+        services.listing_cache.load([(tuple(key), ttl - elapsed, value) for key, ttl, value in listing])
+        for service_id, fetch, version, spec_version in state.get("applied_versions", []):
+            services.applied_versions.setdefault((service_id, plans.Fetch(*fetch)), (version, spec_version))
+        services.secret_index.load_labels(state.get("secret_labels", {}))
+
+        logging.info(
+            f"Loaded state saved {elapsed:.0f}s ago from {self.path}: {len(state.get('schedule', {}))} services, "
+            f"{len(state.get('secret_labels', {}))} secrets"
+        )
+
+
+store = StateStore(os.environ.get("STATE_FILE")) if state_enabled() else None
@@ -0,0 +1,168 @@
+import cProfile
+import datetime
+import functools
+import inspect
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+# The JSON-lines file spans are exported to when TRACE_FILE is set, see `export`
+trace_file = os.environ.get("TRACE_FILE")
+_export_lock = threading.Lock()
+_local = threading.local()
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start = time.time()
+        self.error = None
+
+    def to_dict(self, duration: float) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": duration,
+            "thread": threading.current_thread().name,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def tracing_enabled() -> bool:
+    return trace_file is not None
+
+
+def current() -> Optional[Span]:
+    return getattr(_local, "span", None)
+
+
+@contextmanager
+def attach(parent: Optional[Span]):
+    """Make spans started in this thread children of a span from another thread, e.g. in a worker pool"""
+
+    previous, _local.span = current(), parent
+    try:
+        yield
+    finally:
+        _local.span = previous
+
+
+@contextmanager
+def span(name: str, /, **attributes):
+    """Trace a block as a child of the current span. Does nothing unless TRACE_FILE is set"""
+
+    if not tracing_enabled():
+        yield None
+        return
+
+    parent = current()
+    span_ = Span(name, parent, attributes)
+    _local.span = span_
+    start = time.perf_counter()
+    try:
+        yield span_
+    except Exception as error:
+        span_.error = repr(error)
+        raise
+    finally:
+        _local.span = parent
+        export(span_.to_dict(time.perf_counter() - start))
+
+
+def export(record: dict):
+    line = json.dumps(record, default=str)
+    with _export_lock:
+        with open(trace_file, "a") as file:
+            file.write(line + "\n")
+
+
+def traced(name: str = None, attributes: Tuple[str, ...] = ()) -> Callable:
+    """Trace every call of a function, recording the named arguments as span attributes.
+    Arguments with a `name` (such as Docker services) are recorded by name
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracing_enabled():
+                return func(*args, **kwargs)
+
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            span_attributes = {
+                attribute: getattr(arguments[attribute], "name", arguments[attribute])
+                for attribute in attributes
+                if attribute in arguments
+            }
+            with span(span_name, **span_attributes):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class CycleProfiler:
+    """Profiles every call run through it, across threads, and dumps the combined stats of a cycle to PROFILE_DIR"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def run(self, func: Callable, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer Pythons only allow one active profiler per process
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def dump(self) -> Optional[str]:
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        if not profiles:
+            return None
+
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"cycle-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.prof")
+        stats.dump_stats(path)
+        logging.info(f"Wrote cycle profile to: {path}")
+        return path
+
+
+profiler = CycleProfiler(os.environ["PROFILE_DIR"]) if os.environ.get("PROFILE_DIR") else None
+
+
+def profiled(func: Callable, *args, **kwargs):
+    """Run a function under the cycle profiler when PROFILE_DIR is set"""
+
+    if profiler is None:
+        return func(*args, **kwargs)
+    return profiler.run(func, *args, **kwargs)
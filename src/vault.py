@@ -1,15 +1,34 @@
 import os
+import threading
+import time
 from typing import Optional, Tuple
 import logging
 import hvac
 import hvac.exceptions
+import requests
 from hvac.api.auth_methods.userpass import Userpass
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import cache
+import metrics
+import tracing
+
+# Read-through cache of KV v2 responses keyed by (mount_point, path), shared by every service in a cycle
+secret_cache = cache.from_env("VAULT")
+metadata_cache = cache.from_env("VAULT_METADATA")
+
+
+def metadata_first() -> bool:
+    """Only read secret data when the KV v2 metadata shows a new version (VAULT_METADATA_FIRST)"""
+
+    return os.environ.get("VAULT_METADATA_FIRST", "false").lower() in ("1", "true", "yes")
 
 
 def get_connection(url: str) -> hvac.Client:
     """Establish the Vault connection"""
 
-    client = hvac.Client(url=url)
+    client = hvac.Client(url=url, session=get_http_session(), timeout=get_timeout())
     authenticated_client = authenticate_vault(client)
 
     if not authenticated_client.is_authenticated():
@@ -20,8 +39,111 @@ def get_connection(url: str) -> hvac.Client:
     return authenticated_client
 
 
-def get_secret_data_version(client: hvac.Client, path: str, secret: str, mount_point=None) -> Tuple[dict, int]:
-    """Get a Vault secret and its version"""
+class Session:
+    """A long-lived authenticated Vault client.
+
+    The token TTL is looked up after logging in and the token is renewed with renew-self once
+    VAULT_RENEW_FRACTION of its TTL has passed. The client only logs in again when renewal fails,
+    the token is not renewable or the session was invalidated.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.renew_fraction = float(os.environ.get("VAULT_RENEW_FRACTION", 2 / 3))
+        self._client = None
+        self._renew_at = None
+        self._renewable = False
+        self._lock = threading.Lock()
+
+    def client(self) -> hvac.Client:
+        """Return the authenticated client, renewing its token or logging in again if needed"""
+
+        with self._lock:
+            if self._client is None:
+                self._login()
+            elif self._renew_at is not None and time.monotonic() >= self._renew_at:
+                self._renew()
+            return self._client
+
+    def invalidate(self):
+        """Log in again the next time the client is used"""
+
+        with self._lock:
+            self._client = None
+
+    def _login(self):
+        with metrics.api_call("vault", "login"):
+            self._client = get_connection(self.url)
+            data = self._client.auth.token.lookup_self().get("data", {})
+        self._renewable = data.get("renewable", False)
+        self._track_ttl(data.get("ttl", 0))
+
+    def _renew(self):
+        if not self._renewable:
+            logging.info("Vault token is not renewable, logging in again")
+            return self._login()
+
+        try:
+            with metrics.api_call("vault", "renew_self"):
+                response = self._client.auth.token.renew_self()
+        except hvac.exceptions.VaultError as error:
+            logging.warning(f"Failed to renew the Vault token: {error}. Logging in again")
+            return self._login()
+
+        logging.info("Renewed the Vault token")
+        self._track_ttl(response.get("auth", {}).get("lease_duration", 0))
+
+    def _track_ttl(self, ttl: int):
+        # A TTL of 0 is a token that never expires (e.g. a root token)
+        self._renew_at = time.monotonic() + ttl * self.renew_fraction if ttl else None
+
+
+session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> Session:
+    """Return the shared Vault session for VAULT_ADDRESS"""
+
+    global session
+    with _session_lock:
+        if session is None:
+            session = Session(get_vault_url())
+        return session
+
+
+def get_http_session() -> requests.Session:
+    """A requests session with a connection pool of VAULT_POOL_SIZE connections kept alive between requests,
+    retrying idempotent requests up to VAULT_RETRIES times with an exponential backoff on 429 and 5xx responses
+    """
+
+    pool_size = int(os.environ.get("VAULT_POOL_SIZE", 10))
+    retries = Retry(
+        total=int(os.environ.get("VAULT_RETRIES", 3)),
+        backoff_factor=float(os.environ.get("VAULT_RETRY_BACKOFF", 0.5)),
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD", "LIST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_timeout() -> Tuple[float, float]:
+    """The (connect, read) timeout of Vault requests"""
+
+    return (
+        float(os.environ.get("VAULT_CONNECT_TIMEOUT", 5)),
+        float(os.environ.get("VAULT_READ_TIMEOUT", 30)),
+    )
+
+
+def resolve_path(path: str, secret: str, mount_point=None) -> Tuple[str, str]:
+    """Resolve a label key or plain path to its (mount_point, path) in Vault"""
 
     # Handle dot-separated paths (which must be fully qualified)
     if '.' in path:
@@ -29,18 +151,29 @@ def get_secret_data_version(client: hvac.Client, path: str, secret: str, mount_p
     if ":" in path:
         path = path.split(":")[0]
 
-    response = client.secrets.kv.v2.read_secret_version(path=path, mount_point=mount_point)
-    version = response.get("data", {}).get("metadata", {}).get("version", 0)
-    if secret == "all":
-        data = response.get("data", {}).get("data", None)
-    else:
-        if ":" in secret:
-            secret_, key = secret.split(":")
-            data = {key: response.get("data", {}).get("data", {}).get(secret_, None)}
-        else:
-            data = {secret: response.get("data", {}).get("data", {}).get(secret, None)}
+    return mount_point, path
+
+
+@tracing.traced(attributes=("path", "mount_point"))
+def read_secret_version(client: hvac.Client, path: str, mount_point: str) -> dict:
+    """Read the latest version of a KV v2 secret through the secret cache"""
+
+    def read():
+        with metrics.api_call("vault", "read_secret_version"):
+            return client.secrets.kv.v2.read_secret_version(path=path, mount_point=mount_point)
+
+    return secret_cache.get_or_load((mount_point, path), read)
+
+
+@tracing.traced(attributes=("path", "mount_point"))
+def read_secret_metadata(client: hvac.Client, path: str, mount_point: str) -> dict:
+    """Read the KV v2 metadata (current_version, updated_time) of a secret through the metadata cache"""
+
+    def read():
+        with metrics.api_call("vault", "read_secret_metadata"):
+            return client.secrets.kv.v2.read_secret_metadata(path=path, mount_point=mount_point)
 
-    return data, version
+    return metadata_cache.get_or_load((mount_point, path), read)
 
 
 def get_vault_url() -> str:
@@ -0,0 +1,71 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+import docker
+import docker.errors
+from docker.models.services import Service as DockerService
+
+import services
+
+
+def watch_enabled() -> bool:
+    """Reconcile services as soon as they are created or updated (WATCH_EVENTS)"""
+
+    return os.environ.get("WATCH_EVENTS", "false").lower() in ("1", "true", "yes")
+
+
+def start(reconcile: Callable[[DockerService], None], client: docker.DockerClient = None) -> threading.Thread:
+    """Watch the Docker events stream in a background thread"""
+
+    thread = threading.Thread(target=watch_events, args=(reconcile, client), name="watch-events", daemon=True)
+    thread.start()
+    return thread
+
+
+def watch_events(reconcile: Callable[[DockerService], None], client: docker.DockerClient = None):
+    """Reconcile every service with vault labels that is created or updated, reconnecting if the stream drops"""
+
+    client = client or services.get_docker_client()
+    retry_interval = int(os.environ.get("WATCH_RETRY_INTERVAL", 10))
+
+    while True:
+        try:
+            logging.info("Watching Docker events for service create and update")
+            events = client.events(filters={"type": "service", "event": ["create", "update"]}, decode=True)
+            for event in events:
+                handle_event(event, reconcile, client)
+        except Exception as error:
+            logging.error(f"Docker events stream failed: {error}. Reconnecting in {retry_interval}s")
+            time.sleep(retry_interval)
+
+
+def handle_event(event: dict, reconcile: Callable[[DockerService], None], client: docker.DockerClient = None) -> bool:
+    """Reconcile the service an event refers to. Returns False if the event was ignored"""
+
+    actor = event.get("Actor", {})
+    if "updatestate.new" in actor.get("Attributes", {}):
+        # Progress of a rolling update, the spec itself has not changed
+        return False
+
+    try:
+        service = services.id_to_service(actor.get("ID"), client)
+    except docker.errors.NotFound:
+        return False
+
+    if not services.has_vault_labels(service):
+        return False
+
+    if services.is_own_update(service):
+        logging.debug(f"Ignoring {event.get('Action')} event caused by our own update of service: {service.name}")
+        return False
+
+    logging.info(f"Reconciling service: {service.name} after {event.get('Action')} event")
+    try:
+        reconcile(service)
+    except Exception:
+        logging.exception(f"Failed to reconcile service: {service.name}")
+
+    return True
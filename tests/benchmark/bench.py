@@ -0,0 +1,222 @@
+"""Offline benchmark of a vault-swarm reconciliation against in-memory Vault and Docker stand-ins.
+
+Every scenario generates a synthetic fleet and runs three cycles of `main.main()`: a cold start, a steady-state
+cycle where nothing changed and a cycle after some Vault paths were rotated. Scenarios with a `jitter` instead run
+a cold start and then every cycle the scheduler asks for over two intervals, on a simulated clock. For each cycle
+it reports the wall time, the API calls by endpoint and the peak memory.
+
+    python tests/benchmark/bench.py             # run every scenario and compare with baseline.json
+    python tests/benchmark/bench.py --update    # store the call counts as the new baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from unittest import mock
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+TESTS_DIR = os.path.dirname(BENCHMARK_DIR)
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+# The in-memory Vault and Docker are shared with the unit tests
+sys.path.insert(0, TESTS_DIR)
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+import fakes  # noqa: E402
+
+SCENARIOS = {
+    "small": {"services": 20, "paths": 10, "depth": 2},
+    "shared": {"services": 200, "paths": 5, "depth": 2},
+    "deep": {"services": 50, "paths": 200, "depth": 5},
+    "jitter": {"services": 200, "paths": 5, "depth": 2, "jitter": 0.1},
+}
+
+# Interval and tick of the scenarios with a jitter, as with the defaults of INTERVAL and SCHEDULER_TICK
+INTERVAL = 300
+TICK = 5
+
+CYCLES = ["cold", "steady", "rotated"]
+
+
+def generate_fleet(vault: fakes.FakeVault, docker: fakes.FakeDocker, services: int, paths: int, depth: int):
+    """Write `paths` secrets spread over a tree of `depth` levels on both mounts and create `services` services
+    with a mix of `vault.secrets`, `vault.envvars`, `all` and `vault:` labels
+    """
+
+    vault_paths = []
+    for index in range(paths):
+        folders = [f"level{level}-{index % (level + 2)}" for level in range(depth - 1)]
+        vault_paths.append("/".join([f"root{index % 3}"] + folders[1:] + [f"secret{index}"]))
+
+    for path in vault_paths:
+        for mount_point in ["secrets", "envvars"]:
+            vault.write(mount_point, path, {"password": f"{path}-1", "USER": f"{path}-user"})
+
+    for index in range(services):
+        path = vault_paths[index % len(vault_paths)]
+        label_path = path.replace("/", ".")
+        labels = [
+            {f"vault.secrets.{label_path}": "all"},
+            {f"vault.secrets.{label_path}": "password:db_password", f"vault.envvars.{label_path}": "USER"},
+            {f"vault.envvars.{label_path}": "all"},
+            {f"vault:{path.split('/')[0]}": "true"},
+        ][index % 4]
+        docker.services.create(f"service{index}", labels=labels, env=["KEEP_ME=true"])
+
+    docker.services.create("unlabelled", labels={"com.example": "true"})
+    return vault_paths
+
+
+def src_modules() -> dict:
+    return {name: module for name, module in sys.modules.items() if os.path.exists(os.path.join(SRC_DIR, f"{name}.py"))}
+
+
+@contextmanager
+def fresh_main():
+    """Import vault-swarm from scratch so no state leaks between scenarios, and put back the modules imported before"""
+
+    previous = src_modules()
+    for name in previous:
+        del sys.modules[name]
+    try:
+        import main
+        yield main
+    finally:
+        for name in src_modules():
+            del sys.modules[name]
+        sys.modules.update(previous)
+
+
+def run_scenario(services: int, paths: int, depth: int, jitter: float = None) -> dict:
+    if jitter is not None:
+        environ = {"INTERVAL": str(INTERVAL), "INTERVAL_JITTER": str(jitter)}
+        with mock.patch.dict(os.environ, environ), fresh_main() as main:
+            return run_intervals(main, services, paths, depth)
+
+    with mock.patch.dict(os.environ, {"INTERVAL": "0", "INTERVAL_JITTER": "0"}), fresh_main() as main:
+        return run_cycles(main, services, paths, depth)
+
+
+def run_cycles(main, services: int, paths: int, depth: int) -> dict:
+
+    vault = fakes.FakeVault()
+    docker = fakes.FakeDocker()
+    vault_paths = generate_fleet(vault, docker, services, paths, depth)
+    main.set_docker_client(docker)
+
+    results = {}
+    for cycle in CYCLES:
+        if cycle == "rotated":
+            for path in vault_paths[::5]:
+                for mount_point in ["secrets", "envvars"]:
+                    vault.write(mount_point, path, {"password": f"{path}-2", "USER": f"{path}-user"})
+
+        results[cycle] = measure(lambda: main.main(vault))
+
+    return results
+
+
+def run_intervals(main, services: int, paths: int, depth: int) -> dict:
+    """Run a cold start, then every cycle `main.run()` would run over the next two intervals"""
+
+    vault = fakes.FakeVault()
+    docker = fakes.FakeDocker()
+    generate_fleet(vault, docker, services, paths, depth)
+    main.set_docker_client(docker)
+    now = [0.0]
+
+    def run_until(end):
+        summary = {"cycles": 0}
+        while now[0] < end:
+            summary["cycles"] += 1
+            main.main(vault)
+            now[0] = max(now[0] + TICK, main.schedule.next_due())
+        return summary
+
+    with mock.patch("time.monotonic", lambda: now[0]):
+        return {
+            "cold": measure(lambda: run_until(TICK)),
+            "intervals": measure(lambda: run_until(now[0] + 2 * INTERVAL)),
+        }
+
+
+def measure(run) -> dict:
+    """The wall time, peak memory and API calls of `run()`, with the summary it returns"""
+
+    fakes.calls.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    summary = run()
+    wall_time = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "wall_time": round(wall_time, 4),
+        "peak_memory": peak_memory,
+        "summary": dict(summary),
+        "calls": dict(sorted(fakes.calls.items())),
+    }
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """Return a description of every call count that is higher than in the baseline"""
+
+    regressions = []
+    for scenario, cycles in results.items():
+        for cycle, result in cycles.items():
+            expected = baseline.get(scenario, {}).get(cycle, {})
+            for endpoint, count in result["calls"].items():
+                if count > expected.get(endpoint, 0):
+                    regressions.append(
+                        f"{scenario}/{cycle}: {endpoint} made {count} calls, baseline is {expected.get(endpoint, 0)}"
+                    )
+    return regressions
+
+
+def load_baseline() -> dict:
+    with open(BASELINE) as file:
+        return json.load(file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark vault-swarm against in-memory Vault and Docker")
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS))
+    parser.add_argument("--update", action="store_true", help="store the call counts as the new baseline")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {scenario: run_scenario(**SCENARIOS[scenario]) for scenario in args.scenarios}
+
+    for scenario, cycles in results.items():
+        for cycle, result in cycles.items():
+            calls = ", ".join(f"{endpoint}={count}" for endpoint, count in result["calls"].items())
+            print(
+                f"{scenario:>8} {cycle:>8}: {result['wall_time']:.3f}s, "
+                f"peak {result['peak_memory'] / 1024:.0f} KiB, {dict(result['summary'])}\n{'':>19}{calls}"
+            )
+
+    if args.update:
+        baseline = load_baseline() if os.path.exists(BASELINE) else {}
+        for scenario, cycles in results.items():
+            baseline[scenario] = {cycle: result["calls"] for cycle, result in cycles.items()}
+        with open(BASELINE, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"Updated {BASELINE}")
+        return 0
+
+    regressions = compare(results, load_baseline())
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
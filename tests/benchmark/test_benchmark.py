@@ -0,0 +1,78 @@
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+import bench
+import fakes
+
+
+@pytest.mark.parametrize("scenario", list(bench.SCENARIOS))
+def test_api_calls_do_not_exceed_baseline(scenario):
+    results = {scenario: bench.run_scenario(**bench.SCENARIOS[scenario])}
+
+    assert bench.compare(results, bench.load_baseline()) == []
+
+
+def test_steady_cycle_creates_no_secrets():
+    results = bench.run_scenario(**bench.SCENARIOS["small"])
+
+    assert results["cold"]["summary"]["failed"] == 0
+    assert "docker.secrets.create" not in results["steady"]["calls"]
+    assert results["rotated"]["calls"]["docker.secrets.create"] > 0
+
+
+def test_restart_keeps_envvars_held_back_by_the_coalescer(tmp_path):
+    vault = fakes.FakeVault()
+    docker = fakes.FakeDocker()
+    vault.write("envvars", "app/env", {"USER": "one"})
+    service = docker.services.create("app", labels={"vault.envvars.app.env": "all"}, env=["KEEP=1"])
+    now = [1000.0]
+    environ = {
+        "INTERVAL": "0", "INTERVAL_JITTER": "0", "COALESCE_WINDOW": "60", "VAULT_METADATA_FIRST": "true",
+        "STATE_FILE": str(tmp_path / "state.json"),
+    }
+
+    def run_cycles(*times):
+        with bench.fresh_main() as main:
+            main.set_docker_client(docker)
+            for now[0] in times:
+                main.main(vault)
+
+    with mock.patch.dict(os.environ, environ), mock.patch("time.monotonic", lambda: now[0]):
+        run_cycles(1000, 1061)
+        assert service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Env"] == ["KEEP=1", "USER=one"]
+
+        # The rotation is held back when vault-swarm restarts
+        vault.write("envvars", "app/env", {"USER": "two"})
+        run_cycles(1100)
+        run_cycles(1200, 1261, 1300)
+
+    assert service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Env"] == ["KEEP=1", "USER=two"]
+
+
+def test_service_deployed_after_a_rotation_gets_the_new_version():
+    vault = fakes.FakeVault()
+    docker = fakes.FakeDocker()
+    vault.write("envvars", "app/env", {"USER": "one"})
+    docker.services.create("app", labels={"vault.envvars.app.env": "all"})
+
+    with mock.patch.dict(os.environ, {"INTERVAL": "600"}), bench.fresh_main() as main:
+        main.set_docker_client(docker)
+        main.main(vault)
+
+        # Between sweeps: Vault is rotated, then a new service is deployed and reported by the events stream
+        vault.write("envvars", "app/env", {"USER": "two"})
+        service = docker.services.create("worker", labels={"vault.envvars.app.env": "all"})
+        with mock.patch.object(main.vault, "get_session", lambda: SimpleNamespace(client=lambda: vault)):
+            main.reconcile_event(service)
+
+    assert service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Env"] == ["USER=two"]
+
+
+def test_jitter_does_not_split_an_interval_into_more_cycles():
+    results = bench.run_scenario(**bench.SCENARIOS["jitter"])
+
+    assert results["intervals"]["summary"]["cycles"] == 2
+    assert results["intervals"]["calls"]["docker.services.list"] == 2
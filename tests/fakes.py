@@ -0,0 +1,208 @@
+"""In-memory stand-ins for the parts of the hvac and Docker clients vault-swarm uses.
+
+Every call is counted in `calls` by endpoint, e.g. "vault.read_secret_version" or "docker.services.update".
+"""
+import datetime
+import itertools
+from collections import Counter
+
+from hvac.exceptions import InvalidPath
+
+calls = Counter()
+_ids = itertools.count(1)
+
+
+def next_id(prefix: str) -> str:
+    return f"{prefix}{next(_ids):08d}"
+
+
+class Namespace:
+    pass
+
+
+class FakeKV2:
+    def __init__(self, store: dict, deleted: set):
+        self.store = store
+        self.deleted = deleted
+        # The (mount_point, path) of every read and list, in order
+        self.reads = []
+        self.listed = []
+
+    def read_secret_version(self, path, mount_point=None, **kwargs):
+        calls["vault.read_secret_version"] += 1
+        self.reads.append((mount_point, path))
+        versions = self.store.get((mount_point, path))
+        if not versions or (mount_point, path) in self.deleted:
+            raise InvalidPath()
+        return {"data": {"data": dict(versions[-1]), "metadata": {"version": len(versions)}}}
+
+    def read_secret_metadata(self, path, mount_point=None, **kwargs):
+        calls["vault.read_secret_metadata"] += 1
+        versions = self.store.get((mount_point, path))
+        if not versions:
+            raise InvalidPath()
+        return {"data": {"current_version": len(versions), "updated_time": f"version-{len(versions)}"}}
+
+    def list_secrets(self, path, mount_point=None, **kwargs):
+        calls["vault.list_secrets"] += 1
+        path = path.strip("/")
+        self.listed.append((mount_point, path))
+        keys = set()
+        for secret_mount_point, secret_path in self.store:
+            if secret_mount_point != mount_point or (path and not secret_path.startswith(f"{path}/")):
+                continue
+            head, separator, _ = secret_path[len(path) + 1 if path else 0:].partition("/")
+            keys.add(head + separator)
+        if not keys:
+            raise InvalidPath()
+        return {"data": {"keys": sorted(keys)}}
+
+
+class FakeVault:
+    """A KV v2 Vault holding every version of every secret in memory"""
+
+    def __init__(self):
+        self.store = {}
+        self.deleted = set()
+        self.token = "token"
+        self.secrets = Namespace()
+        self.secrets.kv = Namespace()
+        self.secrets.kv.v2 = FakeKV2(self.store, self.deleted)
+        self.auth = Namespace()
+        self.auth.token = Namespace()
+        self.auth.token.lookup_self = lambda: {"data": {"ttl": 0, "renewable": False}}
+
+    def is_authenticated(self):
+        return True
+
+    def write(self, mount_point: str, path: str, data: dict):
+        self.store.setdefault((mount_point, path), []).append(data)
+        self.deleted.discard((mount_point, path))
+
+    def delete(self, mount_point: str, path: str):
+        """Soft delete the latest version: its metadata can still be read but its data can not"""
+
+        self.deleted.add((mount_point, path))
+
+
+class FakeSecret:
+    def __init__(self, secrets: "FakeSecrets", name: str, labels: dict):
+        self._secrets = secrets
+        self.id = next_id("secret")
+        self.name = name
+        self.attrs = {
+            "ID": self.id,
+            "CreatedAt": datetime.datetime.utcnow().isoformat() + "Z",
+            "Spec": {"Name": name, "Labels": labels or {}},
+        }
+
+    def reload(self):
+        calls["docker.secrets.inspect"] += 1
+
+    def remove(self):
+        calls["docker.secrets.remove"] += 1
+        del self._secrets.items[self.id]
+        return True
+
+
+class FakeSecrets:
+    def __init__(self):
+        self.items = {}
+
+    def list(self, filters=None):
+        calls["docker.secrets.list"] += 1
+        return [secret for secret in self.items.values() if matches_filters(secret, filters)]
+
+    def get(self, secret_id):
+        calls["docker.secrets.inspect"] += 1
+        return self.items[secret_id]
+
+    def create(self, name, data, labels=None, **kwargs):
+        calls["docker.secrets.create"] += 1
+        secret = FakeSecret(self, name, labels)
+        self.items[secret.id] = secret
+        return secret
+
+
+class FakeService:
+    def __init__(self, name: str, labels: dict, env: list):
+        self.id = next_id("service")
+        self.short_id = self.id[:10]
+        self.name = name
+        self.attrs = {
+            "ID": self.id,
+            "Version": {"Index": next(_ids)},
+            "Spec": {
+                "Name": name,
+                "Labels": labels,
+                "TaskTemplate": {
+                    "ContainerSpec": {
+                        "Labels": {"com.docker.stack.namespace": "benchmark"},
+                        "Env": env,
+                        "Secrets": [],
+                    }
+                },
+            },
+        }
+
+    def update(self, env=None, secrets=None, labels=None, **kwargs):
+        calls["docker.services.update"] += 1
+        container_spec = self.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]
+        if env is not None:
+            container_spec["Env"] = list(env)
+        if secrets is not None:
+            container_spec["Secrets"] = [
+                {"SecretID": secret["SecretID"], "SecretName": secret["SecretName"], "File": secret.get("File")}
+                for secret in secrets
+            ]
+        if labels is not None:
+            self.attrs["Spec"]["Labels"] = dict(labels)
+        self.attrs["Version"]["Index"] = next(_ids)
+        return True
+
+    def reload(self):
+        calls["docker.services.inspect"] += 1
+
+    def tasks(self, filters=None):
+        calls["docker.services.tasks"] += 1
+        return []
+
+
+class FakeServices:
+    def __init__(self):
+        self.items = {}
+
+    def list(self, filters=None, **kwargs):
+        calls["docker.services.list"] += 1
+        return [service for service in self.items.values() if matches_filters(service, filters)]
+
+    def get(self, service_id, **kwargs):
+        calls["docker.services.inspect"] += 1
+        return self.items[service_id]
+
+    def create(self, name, labels=None, env=None, **kwargs):
+        service = FakeService(name, labels or {}, env or [])
+        self.items[service.id] = service
+        return service
+
+
+class FakeDocker:
+    """A swarm manager holding services and secrets in memory"""
+
+    def __init__(self):
+        self.services = FakeServices()
+        self.secrets = FakeSecrets()
+
+    def events(self, **kwargs):
+        return iter([])
+
+
+def matches_filters(item, filters) -> bool:
+    """Apply the `label` filter of the Docker API: `key` or `key=value`"""
+
+    labels = item.attrs["Spec"].get("Labels", {})
+    for label in (filters or {}).get("label", []):
+        key, _, value = label.partition("=")
+        if key not in labels or (value and labels[key] != value):
+            return False
+    return True
@@ -1,9 +1,38 @@
+import itertools
 from time import sleep
 
 import docker
 import pytest
 from docker.types import SecretReference
 
+import fakes
+
+
+# Like Docker's, spec versions are unique across services
+spec_versions = itertools.count(1)
+
+
+class ServiceStub:
+    """The parts of a Docker service read by the label, dependency and event handling, without a swarm"""
+
+    def __init__(self, id, labels):
+        self.id = self.name = id
+        self.attrs = {"Version": {"Index": next(spec_versions)}, "Spec": {"Labels": labels}}
+
+
+@pytest.fixture()
+def make_service():
+    """Build a service stub from its ID and labels, with a new spec version every time"""
+
+    return ServiceStub
+
+
+@pytest.fixture()
+def fake_vault():
+    """An in-memory KV v2 Vault, the one the benchmark runs against"""
+
+    return fakes.FakeVault()
+
 
 @pytest.fixture()
 def docker_secret():
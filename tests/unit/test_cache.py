@@ -0,0 +1,106 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+
+
+def test_get_or_load_counts_hits_and_misses():
+    cache = LRUCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return {"data": "value"}
+
+    assert cache.get_or_load(("secrets", "test"), loader) == {"data": "value"}
+    assert cache.get_or_load(("secrets", "test"), loader) == {"data": "value"}
+
+    assert len(calls) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+
+
+def test_new_cycle_without_ttl_clears_entries():
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.new_cycle()
+
+    assert "a" not in cache
+    assert cache.stats()["hits"] == 0
+
+
+def test_new_cycle_with_ttl_keeps_entries():
+    cache = LRUCache(ttl=60)
+    cache.set("a", 1)
+    cache.new_cycle()
+
+    assert cache.get("a") == 1
+
+
+def test_expired_entries_are_dropped():
+    cache = LRUCache(ttl=-1)
+    cache.set("a", 1)
+
+    assert cache.get("a") is None
+
+
+def test_concurrent_misses_load_once():
+    cache = LRUCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return ["secrets/app/key"]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: cache.get_or_load(("secrets", "app"), loader), range(8)))
+
+    assert len(calls) == 1
+    assert all(result == ["secrets/app/key"] for result in results)
+
+
+def test_dump_and_load_keep_expiry():
+    cache = LRUCache(ttl=60)
+    cache.set("a", 1)
+
+    restored = LRUCache(ttl=60)
+    restored.load(cache.dump() + [("b", -1, 2)])
+
+    assert restored.get("a") == 1
+    assert "b" not in restored
+    assert LRUCache().dump() == []
+
+
+def test_forget_cycle_keeps_entries_with_a_ttl():
+    cycle, kept = LRUCache(), LRUCache(ttl=60)
+    cycle.set("a", 1)
+    kept.set("a", 1)
+
+    cycle.forget_cycle("a")
+    kept.forget_cycle("a")
+
+    assert "a" not in cycle
+    assert kept.get("a") == 1
+
+
+def test_take_stats_keeps_counting_across_cycles_until_taken():
+    cache = LRUCache()
+    cache.get_or_load("a", lambda: 1)
+    cache.new_cycle()
+    cache.get_or_load("a", lambda: 1)
+    cache.get_or_load("a", lambda: 1)
+
+    assert cache.take_stats() == {"hits": 1, "misses": 2, "size": 1}
+    assert cache.stats() == {"hits": 0, "misses": 0, "size": 1}
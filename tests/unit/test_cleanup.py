@@ -0,0 +1,35 @@
+import datetime
+from types import SimpleNamespace
+
+from cleanup import find_superseded
+
+NOW = datetime.datetime(2021, 7, 1, 12, 0, 0)
+
+
+def secret(secret_id, version, age, path="app/db", name="password"):
+    created_at = (NOW - datetime.timedelta(seconds=age)).strftime("%Y-%m-%dT%H:%M:%S.123456789Z")
+    labels = {"path": path, "version": str(version), "name": name}
+    return SimpleNamespace(id=secret_id, name=secret_id, attrs={"CreatedAt": created_at, "Spec": {"Labels": labels}})
+
+
+def test_keeps_latest_versions():
+    secrets = [secret(f"v{version}", version, age=7200) for version in range(1, 5)]
+
+    superseded = find_superseded(secrets, referenced=set(), keep=2, min_age=3600, now=NOW)
+
+    assert [secret_.id for secret_ in superseded] == ["v1", "v2"]
+
+
+def test_keeps_referenced_and_recent_secrets():
+    secrets = [secret("v1", 1, age=7200), secret("v2", 2, age=60), secret("v3", 3, age=7200), secret("v4", 4, age=0)]
+
+    superseded = find_superseded(secrets, referenced={"v1"}, keep=1, min_age=3600, now=NOW)
+
+    assert [secret_.id for secret_ in superseded] == ["v3"]
+
+
+def test_ignores_secrets_not_created_by_vault_swarm():
+    unmanaged = SimpleNamespace(id="other", name="other", attrs={"CreatedAt": "2020-01-01T00:00:00Z", "Spec": {}})
+    secrets = [unmanaged, secret("a1", 1, age=7200), secret("b1", 1, age=7200, name="user")]
+
+    assert find_superseded(secrets, referenced=set(), keep=1, min_age=0, now=NOW) == []
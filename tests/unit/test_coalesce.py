@@ -0,0 +1,49 @@
+from coalesce import Coalescer
+
+
+def secret(path, name, version):
+    return {"data": f"{name}-{version}", "version": version, "name": name, "path": path}
+
+
+def test_no_window_passes_changes_through():
+    coalescer = Coalescer(window=0)
+
+    assert coalescer.submit("a", {"KEY": "value"}, []) == ({"KEY": "value"}, [])
+
+
+def test_changes_are_held_until_window_passes():
+    coalescer = Coalescer(window=60)
+
+    assert coalescer.submit("a", {"KEY": "value"}, [], now=0) == ({}, [])
+    assert coalescer.pending() == {"a": 60}
+    assert coalescer.submit("a", {}, [secret("database", "password", 2)], now=30) == ({}, [])
+
+    env_vars, secrets = coalescer.submit("a", {}, [], now=60)
+    assert env_vars == {"KEY": "value"}
+    assert secrets == [secret("database", "password", 2)]
+    assert coalescer.pending() == {}
+    assert coalescer.avoided_updates == 1
+
+
+def test_newest_secret_version_wins():
+    coalescer = Coalescer(window=60)
+    coalescer.submit("a", {}, [secret("database", "password", 2)], now=0)
+    coalescer.submit("a", {}, [secret("database", "password", 3)], now=10)
+
+    _, secrets = coalescer.submit("a", {}, [], now=60)
+    assert secrets == [secret("database", "password", 3)]
+
+
+def test_repeated_identical_change_is_not_counted():
+    coalescer = Coalescer(window=60)
+    coalescer.submit("a", {"KEY": "value"}, [], now=0)
+    coalescer.submit("a", {"KEY": "value"}, [], now=10)
+
+    assert coalescer.avoided_updates == 0
+
+
+def test_nothing_pending_without_changes():
+    coalescer = Coalescer(window=60)
+
+    assert coalescer.submit("a", {}, [], now=0) == ({}, [])
+    assert coalescer.pending() == {}
@@ -0,0 +1,45 @@
+from dependencies import DependencyIndex
+
+
+def test_dependents_of_path_and_key(make_service):
+    index = DependencyIndex()
+    index.update(make_service("a", {"vault.secrets.database": "all"}))
+    index.update(make_service("b", {"vault.envvars.database": "DB_USER:POSTGRES_USER"}))
+    index.update(make_service("c", {"vault.secrets.database": "password"}))
+
+    assert index.dependents("secrets", "database") == {"a", "c"}
+    assert index.dependents("secrets", "database", "password") == {"a", "c"}
+    assert index.dependents("secrets", "database", "user") == {"a"}
+    assert index.dependents("envvars", "database", "DB_USER") == {"b"}
+
+
+def test_dependents_under_root_path(make_service):
+    index = DependencyIndex()
+    index.update(make_service("a", {"vault:app.certs": "true"}))
+
+    assert index.dependents("secrets", "app/certs/live/privkey") == {"a"}
+    assert index.dependents("envvars", "app/certs/conf") == {"a"}
+    assert index.dependents("secrets", "app/other") == set()
+
+
+def test_update_only_reindexes_new_spec_version(make_service):
+    index = DependencyIndex()
+    service = make_service("a", {"vault.secrets.database": "all"})
+
+    assert index.update(service)
+    assert not index.update(service)
+
+    assert index.update(make_service("a", {"vault.secrets.cache": "all"}))
+    assert index.dependents("secrets", "database") == set()
+    assert index.dependents("secrets", "cache") == {"a"}
+
+
+def test_retain_drops_removed_services(make_service):
+    index = DependencyIndex()
+    index.update(make_service("a", {"vault.secrets.database": "all"}))
+    index.update(make_service("b", {"vault.secrets.database": "all"}))
+    index.update(make_service("c", {"vault.secrets.cache": "all"}))
+    index.retain(["b"])
+
+    assert index.dependents("secrets", "database") == {"b"}
+    assert index.paths() == [("secrets", "database")]
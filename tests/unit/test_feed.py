@@ -0,0 +1,75 @@
+import pytest
+
+import cache
+import feed
+import vault
+from dependencies import DependencyIndex
+
+
+@pytest.fixture()
+def metadata(monkeypatch):
+    """Vault metadata by (mount_point, path), read by the feed instead of Vault"""
+
+    metadata = {}
+    monkeypatch.setattr(feed, "read_metadata", lambda client, mount_point, path: metadata.get((mount_point, path)))
+    return metadata
+
+
+def test_first_poll_only_records_paths(metadata):
+    metadata[("secrets", "database")] = (1, "2024-01-01T00:00:00Z")
+    change_feed = feed.ChangeFeed()
+
+    assert change_feed.poll(None, [("secrets", "database")]) == []
+    assert change_feed.poll(None, [("secrets", "database")]) == []
+
+
+def test_poll_reports_new_versions_and_metadata_updates(metadata):
+    paths = [("secrets", "database"), ("secrets", "api"), ("envvars", "app")]
+    metadata.update({path: (1, "2024-01-01T00:00:00Z") for path in paths})
+    change_feed = feed.ChangeFeed()
+    change_feed.poll(None, paths)
+
+    metadata[("secrets", "database")] = (2, "2024-01-02T00:00:00Z")
+    # e.g. a version deleted and undeleted, which only moves updated_time
+    metadata[("envvars", "app")] = (1, "2024-01-02T00:00:00Z")
+
+    assert sorted(change_feed.poll(None, paths)) == [("envvars", "app"), ("secrets", "database")]
+    assert change_feed.poll(None, paths) == []
+
+
+def test_poll_reports_deleted_paths_and_seeds_new_ones(metadata):
+    metadata[("secrets", "database")] = (1, "2024-01-01T00:00:00Z")
+    change_feed = feed.ChangeFeed()
+    change_feed.poll(None, [("secrets", "database")])
+
+    del metadata[("secrets", "database")]
+    metadata[("secrets", "api")] = (1, "2024-01-01T00:00:00Z")
+
+    assert change_feed.poll(None, [("secrets", "database"), ("secrets", "api")]) == [("secrets", "database")]
+
+
+def test_poll_changes_reconciles_dependents_of_changed_paths(metadata, monkeypatch, make_service):
+    index = DependencyIndex()
+    index.update(make_service("a", {"vault.secrets.database": "all"}))
+    index.update(make_service("b", {"vault.secrets.api": "token"}))
+    monkeypatch.setattr(feed, "dependency_index", index)
+    monkeypatch.setattr(feed, "change_feed", feed.ChangeFeed())
+    metadata.update({("secrets", "database"): (1, "t1"), ("secrets", "api"): (1, "t1")})
+    monkeypatch.setattr(vault, "secret_cache", cache.LRUCache())
+    monkeypatch.setattr(vault, "metadata_cache", cache.LRUCache())
+    vault.secret_cache.set(("secrets", "database"), {"data": {}})
+
+    def sleep(interval):
+        if len(polls) == 2:
+            raise KeyboardInterrupt
+        polls.append(interval)
+        if len(polls) == 2:
+            metadata[("secrets", "database")] = (2, "t2")
+
+    polls, reconciled = [], []
+    monkeypatch.setattr(feed.time, "sleep", sleep)
+    with pytest.raises(KeyboardInterrupt):
+        feed.poll_changes(reconciled.append, lambda: None)
+
+    assert reconciled == [{"a"}]
+    assert ("secrets", "database") not in vault.secret_cache
@@ -0,0 +1,77 @@
+import hvac.exceptions
+
+import cleanup
+import main
+import sharding
+import vault
+
+
+class Service:
+    def __init__(self, id):
+        self.id = self.name = id
+
+
+class Session:
+    def __init__(self):
+        self.invalidated = 0
+
+    def invalidate(self):
+        self.invalidated += 1
+
+
+def test_failing_service_does_not_stop_the_others(monkeypatch):
+    def reconcile_service(client, service):
+        if service.id == "broken":
+            raise RuntimeError("Docker refused the update")
+        return main.SKIPPED if service.id == "unchanged" else main.SUCCEEDED
+
+    monkeypatch.setattr(main, "reconcile_service", reconcile_service)
+    services = [Service("app"), Service("broken"), Service("unchanged")]
+
+    results = main.reconcile_services(None, services)
+
+    assert results == {"app": main.SUCCEEDED, "broken": main.FAILED, "unchanged": main.SKIPPED}
+    assert main.summarize(results) == {main.SUCCEEDED: 1, main.FAILED: 1, main.SKIPPED: 1}
+
+
+def test_refused_token_invalidates_the_vault_session(monkeypatch):
+    session = Session()
+
+    def reconcile_service(client, service):
+        raise hvac.exceptions.Forbidden()
+
+    monkeypatch.setattr(main, "reconcile_service", reconcile_service)
+    monkeypatch.setattr(vault, "get_session", lambda: session)
+
+    assert main.reconcile_services(None, [Service("app")]) == {"app": main.FAILED}
+    assert session.invalidated == 1
+
+
+def test_cleanup_runs_at_most_once_per_interval(monkeypatch):
+    runs, now = [], [0]
+    monkeypatch.setenv("SECRET_CLEANUP", "true")
+    monkeypatch.setattr(cleanup, "cleanup", lambda: runs.append(now[0]))
+    monkeypatch.setattr(cleanup, "_last_run", None)
+    monkeypatch.setattr(cleanup.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(main.schedule, "interval", 300)
+
+    for now[0] in (0, 5, 295, 300, 305):
+        main.run_cleanup()
+
+    assert runs == [0, 300]
+
+
+def test_cleanup_runs_on_one_replica_only(monkeypatch):
+    runs = []
+    monkeypatch.setenv("SECRET_CLEANUP", "true")
+    monkeypatch.setenv("SHARDING", "true")
+    monkeypatch.setattr(cleanup, "cleanup", lambda: runs.append(sharding.shard.member))
+
+    for member in ("a", "b", "c"):
+        monkeypatch.setattr(cleanup, "_last_run", None)
+        shard = sharding.Shard()
+        shard.member, shard.members = member, ("a", "b", "c")
+        monkeypatch.setattr(sharding, "shard", shard)
+        main.run_cleanup()
+
+    assert runs == [sharding.owner(cleanup.OWNER_KEY, ("a", "b", "c"))]
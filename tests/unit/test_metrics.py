@@ -0,0 +1,38 @@
+import pytest
+
+from metrics import Counter, Histogram, api_call, api_calls, api_errors
+
+
+def test_counter_renders_labels():
+    counter = Counter("test_total", "A test counter", ("result",))
+    counter.inc(result="succeeded")
+    counter.inc(2, result="failed")
+
+    assert counter.render().splitlines() == [
+        "# HELP test_total A test counter",
+        "# TYPE test_total counter",
+        'test_total{result="failed"} 2',
+        'test_total{result="succeeded"} 1',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_seconds", "A test histogram", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    samples = histogram.samples()
+    assert 'test_seconds_bucket{le="0.1"} 1' in samples
+    assert 'test_seconds_bucket{le="1"} 2' in samples
+    assert 'test_seconds_bucket{le="+Inf"} 3' in samples
+    assert "test_seconds_count 3" in samples
+
+
+def test_api_call_counts_errors():
+    with pytest.raises(ValueError):
+        with api_call("vault", "test_operation"):
+            raise ValueError()
+
+    assert api_calls.value(backend="vault", operation="test_operation") == 1
+    assert api_errors.value(backend="vault", operation="test_operation") == 1
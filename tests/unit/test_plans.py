@@ -0,0 +1,50 @@
+import pytest
+
+from plans import Fetch, PlanError, Root, compile_label, compile_labels
+
+
+@pytest.mark.parametrize("key, label, fetch", [
+    ("vault.secrets.database", "all", Fetch("secrets", "database", None, None, "vault.secrets.database")),
+    ("vault.secrets.app.database", "password", Fetch("secrets", "app/database", "password", None,
+                                                     "vault.secrets.app.database")),
+    ("vault.envvars.database", "DB_USER:POSTGRES_USER", Fetch("envvars", "database", "DB_USER", "POSTGRES_USER",
+                                                              "vault.envvars.database")),
+])
+def test_compile_label(key, label, fetch):
+    assert compile_label(key, label) == fetch
+
+
+@pytest.mark.parametrize("key, label", [
+    ("vault.secrets", "all"),
+    ("vault.secrets.database", ""),
+    ("vault.secrets.database", "password:"),
+    ("vault.secrets.database", "a:b:c"),
+    ("vault.secrets.database", "all:renamed"),
+    ("vault.files.database", "all"),
+])
+def test_compile_label_rejects_invalid_labels(key, label):
+    with pytest.raises(PlanError):
+        compile_label(key, label)
+
+
+def test_compile_labels_keeps_label_order_and_reports_errors():
+    plan = compile_labels({
+        "vault.envvars.database": "all",
+        "vault:app.certs": "true",
+        "vault.secrets.database": "",
+        "com.docker.stack.namespace": "app",
+    })
+
+    assert plan.steps == (Fetch("envvars", "database", None, None, "vault.envvars.database"), Root("app/certs"))
+    assert len(plan.errors) == 1
+    assert plan.bindings() == [
+        ("envvars", "database", "all"), ("secrets", "app/certs", None), ("envvars", "app/certs", None)
+    ]
+
+
+def test_expand_roots_keeps_dotted_paths():
+    plan = compile_labels({"vault:app": "true"})
+
+    fetches = plan.expand(lambda root, mount_point: [f"{root}/cert.pem"] if mount_point == "secrets" else [])
+
+    assert fetches == [Fetch("secrets", "app/cert.pem", None, None, "app/cert.pem")]
@@ -0,0 +1,121 @@
+import os
+import signal
+
+import pytest
+
+import pull
+import vault
+
+
+@pytest.fixture()
+def client(tmp_path, monkeypatch, fake_vault):
+    monkeypatch.setattr(pull, "get_or_create_folder", lambda root_path: str(tmp_path))
+    fake_vault.write("secrets", "app/db", {"password": "one"})
+    fake_vault.write("secrets", "app/api", {"token": "two"})
+    fake_vault.write("envvars", "app/env", {"USER": "admin"})
+    yield fake_vault
+    vault.secret_cache.invalidate()
+    vault.metadata_cache.invalidate()
+
+
+def test_pull_writes_files_and_manifest(client, tmp_path):
+    pull.pull("app", client)
+
+    assert (tmp_path / "password").read_text() == "one"
+    assert (tmp_path / "token").read_text() == "two"
+    assert (tmp_path / "envvars").read_text() == "USER=admin\n"
+    assert (tmp_path / pull.MANIFEST).exists()
+    assert not [file for file in os.listdir(tmp_path) if file.startswith(".tmp-")]
+
+
+def test_pull_again_only_rewrites_changed_paths(client, tmp_path):
+    pull.pull("app", client)
+    kv = client.secrets.kv.v2
+    kv.reads.clear()
+    client.write("secrets", "app/db", {"password": "three"})
+
+    changed = pull.pull("app", client)
+
+    assert kv.reads == [("secrets", "app/db")]
+    assert changed == [f"{tmp_path}/password"]
+    assert (tmp_path / "password").read_text() == "three"
+
+
+def test_pull_restores_deleted_files(client, tmp_path):
+    pull.pull("app", client)
+    os.unlink(tmp_path / "password")
+    os.unlink(tmp_path / "envvars")
+
+    changed = pull.pull("app", client)
+
+    assert sorted(changed) == [f"{tmp_path}/envvars", f"{tmp_path}/password"]
+    assert (tmp_path / "password").read_text() == "one"
+    assert (tmp_path / "envvars").read_text() == "USER=admin\n"
+
+
+def test_pull_removes_files_of_deleted_keys(client, tmp_path):
+    pull.pull("app", client)
+    client.write("secrets", "app/db", {"username": "admin"})
+
+    pull.pull("app", client)
+
+    assert not (tmp_path / "password").exists()
+    assert (tmp_path / "username").read_text() == "admin"
+
+
+def test_pull_settles_with_an_unreadable_envvars_path(client, tmp_path):
+    client.write("envvars", "app/old", {"OLD": "true"})
+    client.delete("envvars", "app/old")
+
+    assert pull.pull("app", client)
+    vault.secret_cache.invalidate()
+    vault.metadata_cache.invalidate()
+
+    assert pull.pull("app", client) == []
+    assert (tmp_path / "envvars").read_text() == "USER=admin\n"
+
+
+@pytest.mark.parametrize("value", ["SIGUSR1", "USR1", "usr1", str(int(signal.SIGUSR1))])
+def test_get_notify_signal(monkeypatch, value):
+    monkeypatch.setenv("PULL_NOTIFY_SIGNAL", value)
+
+    assert pull.get_notify_signal() == signal.SIGUSR1
+
+
+def test_watch_fails_fast_on_an_invalid_signal(client, monkeypatch):
+    monkeypatch.setenv("PULL_NOTIFY_SIGNAL", "RELOAD")
+
+    with pytest.raises(ValueError):
+        pull.watch("app", client)
+
+
+def test_notify_signals_process_and_touches_sentinel(tmp_path, monkeypatch):
+    signals = []
+    monkeypatch.setattr(os, "kill", lambda pid, signal_: signals.append((pid, signal_.name)))
+    monkeypatch.setenv("PULL_NOTIFY_PID", "42")
+    monkeypatch.setenv("PULL_NOTIFY_SIGNAL", "SIGUSR1")
+    monkeypatch.setenv("PULL_SENTINEL", str(tmp_path / "reload"))
+
+    pull.notify(["/run/secrets/app/password"])
+
+    assert signals == [(42, "SIGUSR1")]
+    assert (tmp_path / "reload").exists()
+
+
+def test_watch_notifies_only_when_files_changed(client, monkeypatch):
+    notified = []
+    monkeypatch.setattr(pull, "notify", lambda changed_files, signal_: notified.append(changed_files))
+
+    def sleep(interval):
+        if len(sleeps) == 2:
+            raise KeyboardInterrupt
+        sleeps.append(interval)
+        client.write("secrets", "app/db", {"password": "three"}) if len(sleeps) == 2 else None
+
+    sleeps = []
+    monkeypatch.setattr(pull.time, "sleep", sleep)
+    with pytest.raises(KeyboardInterrupt):
+        pull.watch("app", client)
+
+    assert len(notified) == 2
+    assert notified[1] == [os.path.join(pull.get_or_create_folder("app"), "password")]
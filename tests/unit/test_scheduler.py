@@ -0,0 +1,47 @@
+from scheduler import Scheduler
+
+
+def test_new_services_are_due_right_away():
+    scheduler = Scheduler(interval=300)
+    scheduler.sync(["a", "b"], now=0)
+
+    assert set(scheduler.due(now=0)) == {"a", "b"}
+
+
+def test_succeeded_service_is_due_after_interval_with_jitter():
+    scheduler = Scheduler(interval=300, jitter=0.1)
+    scheduler.sync(["a"], now=0)
+    scheduler.succeeded("a", now=0)
+
+    assert scheduler.due(now=299) == []
+    assert scheduler.due(now=331) == ["a"]
+    assert 300 <= scheduler.next_due() <= 330
+
+
+def test_services_of_a_cycle_share_their_jitter():
+    scheduler = Scheduler(interval=300, jitter=0.1)
+    scheduler.sync(["a", "b", "c"], now=0)
+    for service_id in ["a", "b", "c"]:
+        scheduler.succeeded(service_id, now=0)
+
+    assert set(scheduler.due(now=scheduler.next_due())) == {"a", "b", "c"}
+
+
+def test_failed_service_backs_off_exponentially():
+    scheduler = Scheduler(interval=300, jitter=0, backoff=10, max_backoff=35)
+    scheduler.sync(["a"], now=0)
+
+    assert scheduler.failed("a", now=0) == 10
+    assert scheduler.failed("a", now=0) == 20
+    assert scheduler.failed("a", now=0) == 35
+
+    scheduler.succeeded("a", now=0)
+    assert scheduler.failed("a", now=0) == 10
+
+
+def test_sync_forgets_removed_services():
+    scheduler = Scheduler(interval=300)
+    scheduler.sync(["a", "b"], now=0)
+    scheduler.sync(["b"], now=0)
+
+    assert scheduler.due(now=0) == ["b"]
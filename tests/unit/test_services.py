@@ -1,5 +1,6 @@
 import docker
 
+import services
 from services import *
 
 
@@ -56,4 +57,158 @@ def test_create_secret():
     secret = create_secret(b"some data", "test_secret", 1,
                   "vault.secrets.ssl-certificates.archive.sustainabilitytool-net:privkey1.pem", "my-test-stack")
 
-    assert secret
\ No newline at end of file
+    assert secret
+
+def test_get_fingerprint_changes_with_versions_env_and_secrets():
+    versions = [("vault.secrets.app.db", "all", 1)]
+    fingerprint = get_fingerprint(versions, ["A=1", "B=2"], [{"SecretID": "abc"}])
+
+    assert get_fingerprint(versions, ["B=2", "A=1"], [{"SecretID": "abc"}]) == fingerprint
+    assert get_fingerprint([("vault.secrets.app.db", "all", 2)], ["A=1", "B=2"], [{"SecretID": "abc"}]) != fingerprint
+    assert get_fingerprint(versions, ["A=1"], [{"SecretID": "abc"}]) != fingerprint
+    assert get_fingerprint(versions, ["A=1", "B=2"], []) != fingerprint
+
+
+def test_is_up_to_date():
+    versions = [("vault.envvars.app.env", "all", 3)]
+    service = docker.models.services.Service(attrs={
+        "Spec": {
+            "Labels": {"vault.envvars.app.env": "all", FINGERPRINT_LABEL: get_fingerprint(versions, ["A=1"], None)},
+            "TaskTemplate": {"ContainerSpec": {"Env": ["A=1"]}},
+        }
+    })
+
+    assert is_up_to_date(service, versions)
+    assert not is_up_to_date(service, [("vault.envvars.app.env", "all", 4)])
+
+    service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Env"] = ["A=2"]
+    assert not is_up_to_date(service, versions)
+
+
+def test_label_cache_parses_labels_again_when_spec_version_changes():
+    service = docker.models.services.Service(attrs={
+        "ID": "service", "Version": {"Index": 1}, "Spec": {"Labels": {"vault.secrets.app": "all", "other": "true"}}
+    })
+    cache = LabelCache()
+
+    assert cache.get(service) == {"vault.secrets.app": "all"}
+
+    service.attrs["Spec"]["Labels"] = {"vault.envvars.app": "all"}
+    assert cache.get(service) == {"vault.secrets.app": "all"}
+
+    service.attrs["Version"]["Index"] = 2
+    assert cache.get(service) == {"vault.envvars.app": "all"}
+
+
+def test_get_service_filters(monkeypatch):
+    assert get_service_filters() is None
+
+    monkeypatch.setenv("SERVICE_LABEL_FILTER", "vault-swarm, com.example.team=payments")
+    assert get_service_filters() == {"label": ["vault-swarm", "com.example.team=payments"]}
+
+
+def test_read_planned_envvars_reads_again_after_a_redeploy(monkeypatch):
+    monkeypatch.setenv("VAULT_METADATA_FIRST", "true")
+    monkeypatch.setattr(plans, "read_version", lambda client, fetch: 3)
+    monkeypatch.setattr(plans, "read_data", lambda client, fetch: ({"A": "1"}, 3))
+    service = docker.models.services.Service(attrs={
+        "ID": "redeployed", "Version": {"Index": 1}, "Spec": {"Name": "app"}
+    })
+    fetch = plans.compile_label("vault.envvars.app.env", "all")
+
+    # Read but not applied yet, e.g. held back by the coalescer
+    read_versions = {}
+    assert read_planned_envvars(None, service, fetch, {}, read_versions) == {"A": "1"}
+    assert read_planned_envvars(None, service, fetch, {}) == {"A": "1"}
+
+    record_applied_versions(service, read_versions)
+    assert read_planned_envvars(None, service, fetch, {}) == {}
+
+    # e.g. `docker stack deploy` reset the env of the service while the Vault version stayed the same
+    service.attrs["Version"]["Index"] = 2
+    assert read_planned_envvars(None, service, fetch, {}) == {"A": "1"}
+
+    # Our own update carries the versions over to the spec version it left
+    move_applied_versions("redeployed", 1, 2)
+    assert read_planned_envvars(None, service, fetch, {}) == {}
+
+
+class Client:
+    def __init__(self, *secrets):
+        self.secrets = self
+        self._secrets = list(secrets)
+        self.lists = 0
+
+    def list(self):
+        self.lists += 1
+        return list(self._secrets)
+
+    def get(self, secret_id):
+        raise AssertionError("Secrets are looked up in the index, not inspected")
+
+
+def make_secret(id, name, version, path):
+    labels = {"name": name, "version": str(version), "path": path}
+    return docker.models.secrets.Secret(attrs={"ID": id, "Spec": {"Name": f"{name}_v{version}", "Labels": labels}})
+
+
+def test_secret_index_lists_secrets_once_per_cycle():
+    client = Client(
+        make_secret("a", "password", 1, "vault.secrets.app"), make_secret("b", "password", 2, "vault.secrets.app")
+    )
+    index = SecretIndex()
+
+    assert index.find(client, "password", 2, "vault.secrets.app").id == "b"
+    assert index.find(client, "password", 3, "vault.secrets.app") is None
+
+    created = make_secret("c", "password", 3, "vault.secrets.app")
+    index.add(created)
+    assert index.find(client, "password", 3, "vault.secrets.app") is created
+    index.remove("a")
+    assert index.find(client, "password", 1, "vault.secrets.app") is None
+    assert client.lists == 1
+
+    index.new_cycle()
+    index.find(client, "password", 2, "vault.secrets.app")
+    assert client.lists == 2
+
+
+def test_get_secret_labels_resolves_ids_from_the_index(monkeypatch):
+    client = Client(make_secret("a", "password", 1, "vault.secrets.app"))
+    monkeypatch.setattr(services, "secret_index", SecretIndex())
+
+    assert get_secret_labels("a", client) == {"name": "password", "version": "1", "path": "vault.secrets.app"}
+    assert get_secret_labels("a", client)["version"] == "1"
+    assert client.lists == 1
+
+
+def test_docker_client_is_created_once_and_shared(monkeypatch):
+    created = []
+    monkeypatch.setattr(docker, "from_env", lambda **kwargs: created.append(kwargs) or object())
+    monkeypatch.setenv("DOCKER_POOL_SIZE", "25")
+    monkeypatch.setattr(services, "docker_client", None)
+
+    assert get_docker_client() is get_docker_client()
+    assert created == [{"max_pool_size": 25}]
+
+    client = object()
+    set_docker_client(client)
+    assert get_docker_client() is client
+
+
+def test_list_secrets_under_path_walks_every_level(fake_vault):
+    for path in ["app/db", "app/certs/tls", "app/certs/ca/root", "other/db"]:
+        fake_vault.write("secrets", path, {"key": "value"})
+
+    assert list_secrets_under_path(fake_vault, "app/", "secrets") == ["app/certs/ca/root", "app/certs/tls", "app/db"]
+    assert sorted(fake_vault.secrets.kv.v2.listed) == [("secrets", "app"), ("secrets", "app/certs"),
+                                                      ("secrets", "app/certs/ca")]
+
+
+def test_walks_are_shared_through_the_listing_cache(monkeypatch, fake_vault):
+    monkeypatch.setattr(services, "listing_cache", cache.LRUCache())
+    fake_vault.write("secrets", "app/db", {"key": "value"})
+
+    assert get_all_secrets_under_path(fake_vault, "app", "secrets") == ["app/db"]
+    assert get_all_secrets_under_path(fake_vault, "app", "secrets") == ["app/db"]
+    assert fake_vault.secrets.kv.v2.listed == [("secrets", "app")]
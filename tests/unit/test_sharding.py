@@ -0,0 +1,61 @@
+from collections import Counter
+
+import docker
+
+import main
+import services
+import sharding
+from sharding import Shard, owner
+
+SERVICE_IDS = [f"service{index}" for index in range(1000)]
+
+
+def test_owner_spreads_services_over_members():
+    owners = Counter(owner(service_id, ["a", "b", "c"]) for service_id in SERVICE_IDS)
+
+    assert set(owners) == {"a", "b", "c"}
+    assert min(owners.values()) > 250
+
+
+def test_only_services_of_a_leaving_member_move():
+    before = {service_id: owner(service_id, ["a", "b", "c"]) for service_id in SERVICE_IDS}
+    after = {service_id: owner(service_id, ["a", "c"]) for service_id in SERVICE_IDS}
+
+    moved = {service_id for service_id in SERVICE_IDS if before[service_id] != after[service_id]}
+    assert moved == {service_id for service_id in SERVICE_IDS if before[service_id] == "b"}
+
+
+class Client:
+    def __init__(self, tasks):
+        self.api = self
+        self._tasks = tasks
+
+    def tasks(self, filters=None):
+        return [{"ID": task, "Status": {"State": "running"}} for task in self._tasks]
+
+
+def test_shard_owns_nothing_until_membership_is_known(monkeypatch):
+    monkeypatch.setenv("SHARD_SERVICE_ID", "vault-swarm")
+    monkeypatch.setenv("SHARD_TASK_ID", "b")
+    shard = Shard()
+
+    assert not shard.owns("service1")
+
+    assert shard.refresh(Client(["a", "c"]))
+    assert shard.members == ("a", "b", "c")
+    assert [shard.owns(service_id) for service_id in SERVICE_IDS].count(True) > 250
+    assert not shard.refresh(Client(["a", "b", "c"]))
+
+
+def test_get_shard_forgets_what_was_applied_to_services_handed_over(monkeypatch):
+    shard = Shard()
+    shard.member, shard.members = "b", ("a", "b")
+    monkeypatch.setattr(shard, "refresh", lambda: False)
+    monkeypatch.setattr(sharding, "shard", shard)
+    owned = next(service_id for service_id in SERVICE_IDS if owner(service_id, ["a", "b"]) == "b")
+    handed_over = next(service_id for service_id in SERVICE_IDS if owner(service_id, ["a", "b"]) == "a")
+    monkeypatch.setattr(services, "applied_versions", {(owned, "fetch"): (3, 1), (handed_over, "fetch"): (3, 1)})
+
+    services_ = [docker.models.services.Service(attrs={"ID": service_id}) for service_id in (owned, handed_over)]
+    assert [service.id for service in main.get_shard(services_)] == [owned]
+    assert services.applied_versions == {(owned, "fetch"): (3, 1)}
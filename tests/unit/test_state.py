@@ -0,0 +1,62 @@
+import json
+
+import plans
+import services
+import state
+import vault
+from cache import LRUCache
+from scheduler import Scheduler
+
+
+def test_save_and_load_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(vault, "metadata_cache", LRUCache(ttl=600))
+    monkeypatch.setattr(services, "listing_cache", LRUCache(ttl=600))
+    monkeypatch.setattr(services, "applied_versions", {})
+    monkeypatch.setattr(services, "secret_index", services.SecretIndex())
+
+    fetch = plans.Fetch("envvars", "app/env", None, None, "vault.envvars.app.env")
+    vault.metadata_cache.set(("envvars", "app/env"), {"data": {"current_version": 3}})
+    services.listing_cache.set(("secrets", "app"), ["app/db"])
+    services.applied_versions[("service", fetch)] = (3, 7)
+    services.secret_index.load_labels({"secret": {"path": "app/db", "version": "3", "name": "password"}})
+    schedule = Scheduler(interval=300)
+    schedule.sync(["service"], now=0)
+    schedule.succeeded("service")
+
+    store = state.StateStore(str(tmp_path / "state.json"))
+    store.save(schedule)
+    assert "password" in json.loads((tmp_path / "state.json").read_text())["secret_labels"]["secret"].values()
+
+    monkeypatch.setattr(vault, "metadata_cache", LRUCache(ttl=600))
+    monkeypatch.setattr(services, "listing_cache", LRUCache(ttl=600))
+    monkeypatch.setattr(services, "applied_versions", {})
+    monkeypatch.setattr(services, "secret_index", services.SecretIndex())
+    restarted = Scheduler(interval=300)
+    state.StateStore(str(tmp_path / "state.json")).load(restarted)
+
+    assert vault.metadata_cache.get(("envvars", "app/env")) == {"data": {"current_version": 3}}
+    assert services.listing_cache.get(("secrets", "app")) == ["app/db"]
+    assert services.applied_versions == {("service", fetch): (3, 7)}
+    assert services.secret_index.labels(None, "secret")["version"] == "3"
+    assert restarted.due() == []
+    assert restarted.next_due() is not None
+
+
+def test_unreadable_state_is_ignored(tmp_path):
+    (tmp_path / "state.json").write_text('{"format": 1, "sched')
+    schedule = Scheduler(interval=300)
+
+    state.StateStore(str(tmp_path / "state.json")).load(schedule)
+
+    assert schedule.next_due() is None
+
+
+def test_state_with_missing_entries_is_loaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(services, "applied_versions", {})
+    (tmp_path / "state.json").write_text(json.dumps({"format": state.FORMAT, "schedule": {"service": 0}}))
+    schedule = Scheduler(interval=300)
+
+    state.StateStore(str(tmp_path / "state.json")).load(schedule)
+
+    assert schedule.next_due() is not None
+    assert services.applied_versions == {}
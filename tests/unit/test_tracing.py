@@ -0,0 +1,58 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import plans
+import tracing
+import vault
+from cache import LRUCache
+
+
+@tracing.traced(attributes=("path", "mount_point"))
+def read(path, mount_point="secrets"):
+    return path
+
+
+def test_spans_are_not_exported_when_disabled(monkeypatch):
+    monkeypatch.setattr(tracing, "trace_file", None)
+
+    with tracing.span("cycle") as span:
+        assert read("database") == "database"
+
+    assert span is None
+
+
+def test_span_tree_across_threads(monkeypatch, tmp_path):
+    trace_file = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(tracing, "trace_file", str(trace_file))
+
+    with tracing.span("cycle"):
+        parent = tracing.current()
+
+        def worker(path):
+            with tracing.attach(parent):
+                return read(path)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(worker, ["database", "cache"]))
+
+    spans = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    cycle = [span for span in spans if span["name"] == "cycle"][0]
+    reads = [span for span in spans if span["name"] == "read"]
+
+    assert cycle["parent_id"] is None
+    assert len(reads) == 2
+    assert all(span["parent_id"] == cycle["span_id"] for span in reads)
+    assert {span["attributes"]["path"] for span in reads} == {"database", "cache"}
+
+
+def test_vault_reads_of_a_plan_are_traced(monkeypatch, tmp_path, fake_vault):
+    trace_file = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(tracing, "trace_file", str(trace_file))
+    monkeypatch.setattr(vault, "secret_cache", LRUCache())
+    fake_vault.write("secrets", "app/db", {"password": "secret"})
+
+    plans.read_data(fake_vault, plans.compile_label("vault.secrets.app.db", "password"))
+
+    span = json.loads(trace_file.read_text())
+    assert span["name"] == "read_secret_version"
+    assert span["attributes"] == {"path": "app/db", "mount_point": "secrets"}
@@ -1,3 +1,6 @@
+import hvac.exceptions
+
+import plans
 import vault
 
 
@@ -26,11 +29,105 @@ def test_read_secret(vault_client):
     assert response["data"]["data"] == {"test": "value"}
 
 
-def test_get_secret_data_version(vault_client, secrets):
-    path, secret = secrets
-    data, version = vault.get_secret_data_version(vault_client, path, secret, "secrets")
+def test_read_data(vault_client, secrets):
+    path, label = secrets
+    data, version = plans.read_data(vault_client, plans.compile_label(path, label, mount_point="secrets"))
 
-    if ":" in secret:
-        secret = secret.split(":")[-1]
-    assert list(data.keys())[0] == secret
+    assert list(data.keys())[0] == label.split(":")[-1]
     assert version == 1
+
+
+class TokenClient:
+    def __init__(self, ttl, renewable=True, renew_error=None):
+        self.logins = 0
+        self.renewals = 0
+        self.ttl = ttl
+        self.renewable = renewable
+        self.renew_error = renew_error
+        self.auth = self
+        self.token = self
+
+    def lookup_self(self):
+        return {"data": {"ttl": self.ttl, "renewable": self.renewable}}
+
+    def renew_self(self):
+        self.renewals += 1
+        if self.renew_error:
+            raise self.renew_error
+        return {"auth": {"lease_duration": self.ttl}}
+
+
+def session_for(monkeypatch, client, ttl_passed):
+    def get_connection(url):
+        client.logins += 1
+        return client
+
+    monkeypatch.setattr(vault, "get_connection", get_connection)
+    monkeypatch.setattr(vault.time, "monotonic", lambda: ttl_passed[0])
+    return vault.Session("http://vault:8200")
+
+
+def test_session_renews_token_instead_of_logging_in(monkeypatch):
+    client = TokenClient(ttl=60)
+    now = [0]
+    session = session_for(monkeypatch, client, now)
+
+    assert session.client() is client
+    session.client()
+    now[0] = 50
+    session.client()
+
+    assert client.logins == 1
+    assert client.renewals == 1
+
+
+def test_session_logs_in_again_when_renewal_fails(monkeypatch):
+    client = TokenClient(ttl=60, renew_error=hvac.exceptions.Forbidden())
+    now = [0]
+    session = session_for(monkeypatch, client, now)
+
+    session.client()
+    now[0] = 50
+    session.client()
+
+    assert client.logins == 2
+
+
+def test_session_never_renews_tokens_without_ttl(monkeypatch):
+    client = TokenClient(ttl=0)
+    now = [0]
+    session = session_for(monkeypatch, client, now)
+
+    session.client()
+    now[0] = 10 ** 6
+    session.client()
+
+    assert client.logins == 1
+    assert client.renewals == 0
+
+
+def test_session_logs_in_again_when_token_is_not_renewable(monkeypatch):
+    client = TokenClient(ttl=60, renewable=False)
+    now = [0]
+    session = session_for(monkeypatch, client, now)
+
+    session.client()
+    now[0] = 50
+    session.client()
+
+    assert client.logins == 2
+    assert client.renewals == 0
+
+
+def test_http_session_pools_connections_and_retries_reads(monkeypatch):
+    monkeypatch.setenv("VAULT_POOL_SIZE", "20")
+    monkeypatch.setenv("VAULT_RETRIES", "5")
+    monkeypatch.setenv("VAULT_READ_TIMEOUT", "12")
+
+    adapter = vault.get_http_session().get_adapter("https://vault:8200")
+
+    assert adapter._pool_maxsize == 20
+    assert adapter.max_retries.total == 5
+    assert 503 in adapter.max_retries.status_forcelist
+    assert "POST" not in adapter.max_retries.allowed_methods
+    assert vault.get_timeout() == (5, 12)
@@ -0,0 +1,69 @@
+import docker.errors
+import pytest
+
+import services
+import watch
+
+
+class Client:
+    def __init__(self, *services_):
+        self.services = self
+        self._services = {service.id: service for service in services_}
+
+    def get(self, service_id):
+        if service_id not in self._services:
+            raise docker.errors.NotFound(service_id)
+        return self._services[service_id]
+
+
+def event(service_id, action="update", **attributes):
+    return {"Type": "service", "Action": action, "Actor": {"ID": service_id, "Attributes": attributes}}
+
+
+@pytest.fixture()
+def client(monkeypatch, make_service):
+    monkeypatch.setattr(services, "own_specs", {})
+    return Client(make_service("app", {"vault.secrets.app": "all"}), make_service("plain", {"other": "true"}))
+
+
+def test_events_of_services_with_vault_labels_are_reconciled(client):
+    reconciled = []
+
+    assert watch.handle_event(event("app", action="create"), reconciled.append, client)
+    assert watch.handle_event(event("app"), reconciled.append, client)
+    assert [service.id for service in reconciled] == ["app", "app"]
+
+
+def test_events_of_other_or_removed_services_are_ignored(client):
+    reconciled = []
+
+    assert not watch.handle_event(event("plain"), reconciled.append, client)
+    assert not watch.handle_event(event("removed"), reconciled.append, client)
+    assert reconciled == []
+
+
+def test_rolling_update_progress_is_ignored(client):
+    reconciled = []
+
+    assert not watch.handle_event(event("app", **{"updatestate.new": "updating"}), reconciled.append, client)
+    assert reconciled == []
+
+
+def test_events_of_our_own_updates_are_ignored(client):
+    reconciled = []
+    service = client.get("app")
+    services.own_specs["app"] = services.get_spec_digest(service)
+
+    assert not watch.handle_event(event("app"), reconciled.append, client)
+
+    # Anyone else changing the spec afterwards is reconciled again
+    service.attrs["Spec"]["Labels"]["vault.envvars.app"] = "all"
+    assert watch.handle_event(event("app"), reconciled.append, client)
+    assert [service.id for service in reconciled] == ["app"]
+
+
+def test_failing_reconcile_does_not_stop_the_watch(client):
+    def reconcile(service):
+        raise RuntimeError("Vault is down")
+
+    assert watch.handle_event(event("app"), reconcile, client)